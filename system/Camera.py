@@ -17,21 +17,167 @@
 # limitations under the License.
 
 import threading
+import multiprocessing
 import time
 import cv2
+import numpy as np
 import ImageUtils
 import logging
 import SurveillanceSystem
 import MotionDetector
 import FaceDetector
+import ZoneMask
 
 #logging.basicConfig(level=logging.DEBUG,
 #                    format='(%(threadName)-10s) %(message)s',
 #                    )
 
+try:
+    from multiprocessing import shared_memory # Python 3.8+
+except ImportError:
+    shared_memory = None
+
 logger = logging.getLogger(__name__)
 
 CAPTURE_HZ = 25.0 # Determines frame rate at which frames are captured from IP camera
+FRAME_BUFFER_SIZE = 4 # Number of preallocated frame slots held by each camera
+FRAME_WAIT_TIMEOUT = 1.0 # Seconds a reader waits for a new frame before giving up
+CAPTURE_STOP_TIMEOUT = 5.0 # Seconds a removed camera waits for its capture thread to exit
+
+class FrameBuffer(object):
+    """The FrameBuffer object is a fixed size ring buffer of 
+    preallocated frame slots. Every captured frame is decoded 
+    straight into the next slot and stamped with a monotonic 
+    sequence number and a capture timestamp, so consumers can 
+    ask for the next frame after the one they last processed 
+    without comparing or copying whole frames. A slot is reused 
+    once FRAME_BUFFER_SIZE newer frames have been captured, 
+    consumers must therefore resize or copy frames they hold on to"""
+
+    def __init__(self, size=FRAME_BUFFER_SIZE):
+        self.size = size
+        self.slots = [None] * size # Preallocated frames, allocated on first capture
+        self.seqs = [0] * size # Sequence number of the frame held in each slot
+        self.timestamps = [0.0] * size # Capture time of the frame held in each slot
+        self.seq = 0 # Sequence number of the most recent frame, 0 means no frame yet
+        self.lock = threading.Lock()
+        self.newFrame = threading.Condition(self.lock) # Notified every time a frame is committed
+
+    def writable_slot(self):
+        """Returns the slot the next frame should be written into"""
+        return self.slots[(self.seq + 1) % self.size]
+
+    def commit(self, frame):
+        """Publishes the frame written into the writable slot. The 
+        frame is stored as the slot in case the decoder had to 
+        reallocate it i.e the stream resolution changed"""
+        with self.lock:
+            index = (self.seq + 1) % self.size
+            self.slots[index] = frame
+            self.timestamps[index] = time.time()
+            self.seq += 1
+            self.seqs[index] = self.seq
+            self.newFrame.notify_all()
+        return self.seq
+
+    def latest(self):
+        """Returns (seq, timestamp, frame) of the most recent frame"""
+        with self.lock:
+            if self.seq == 0:
+                return 0, 0.0, None
+            index = self.seq % self.size
+            return self.seq, self.timestamps[index], self.slots[index]
+
+    def wait_after(self, seq, timeout=FRAME_WAIT_TIMEOUT):
+        """Blocks until a frame newer than seq has been committed
+        and returns it as (seq, timestamp, frame). Returns 
+        (seq, 0.0, None) if no frame arrived within timeout"""
+        with self.lock:
+            if self.seq <= seq:
+                self.newFrame.wait_for(lambda: self.seq > seq, timeout)
+            if self.seq <= seq:
+                return seq, 0.0, None
+            index = self.seq % self.size
+            return self.seq, self.timestamps[index], self.slots[index]
+
+    def get_after(self, seq):
+        """Returns (seq, timestamp, frame) of the most recent frame 
+        if it is newer than seq, otherwise (seq, 0.0, None)"""
+        with self.lock:
+            if self.seq <= seq:
+                return seq, 0.0, None
+            index = self.seq % self.size
+            return self.seq, self.timestamps[index], self.slots[index]
+
+def shared_array(shape, dtype):
+    """Allocates a numpy array backed by shared memory which is 
+    inherited by forked worker processes. Returns the array and the
+    object owning the memory, which must be kept alive with it"""
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if shared_memory is not None:
+        block = shared_memory.SharedMemory(create=True, size=nbytes)
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf), block
+    block = multiprocessing.RawArray('b', nbytes) # Anonymous shared mmap on older pythons
+    return np.frombuffer(block, dtype=dtype).reshape(shape), block
+
+class SharedFrameBuffer(FrameBuffer):
+    """A FrameBuffer whose slots, sequence numbers and timestamps 
+    live in shared memory, so frames written by a camera's capture 
+    thread can be read by a forked processing worker without being
+    copied. Slots have a fixed shape, frames of any other size are 
+    resized into the slot"""
+
+    def __init__(self, shape, size=FRAME_BUFFER_SIZE):
+        self.size = size
+        self.shape = tuple(shape)
+        frames, self._framesBlock = shared_array((size,) + self.shape, np.uint8)
+        self.slots = [frames[i] for i in range(size)]
+        header, self._headerBlock = shared_array((size + 1,), np.int64)
+        self._header = header # Most recent sequence number followed by each slot's sequence number
+        self._header[:] = 0
+        self.seqs = header[1:]
+        self.timestamps, self._timestampsBlock = shared_array((size,), np.float64)
+        context = multiprocessing.get_context('fork')
+        self.lock = context.Lock()
+        self.newFrame = context.Condition(self.lock)
+        self.closed = False
+
+    @property
+    def seq(self):
+        if self.closed: # Readers of a removed camera see no frames
+            return 0
+        return int(self._header[0])
+
+    @seq.setter
+    def seq(self, value):
+        self._header[0] = value
+
+    def commit(self, frame):
+        index = (self.seq + 1) % self.size
+        slot = self.slots[index]
+        if frame is not slot: # The decoder did not write into the slot
+            if frame.shape == slot.shape:
+                np.copyto(slot, frame)
+            else:
+                cv2.resize(frame, (self.shape[1], self.shape[0]), dst=slot, interpolation=cv2.INTER_AREA)
+        with self.lock:
+            self.timestamps[index] = time.time()
+            self.seq += 1
+            self.seqs[index] = self.seq
+            self.newFrame.notify_all()
+        return self.seq
+
+    def close(self):
+        """Releases the shared memory, only called by the process that
+        created it once nothing writes to the buffer any more"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        for block in (self._framesBlock, self._headerBlock, self._timestampsBlock):
+            if shared_memory is not None and isinstance(block, shared_memory.SharedMemory):
+                block.close()
+                block.unlink()
 
 class IPCamera(object):
     """The IPCamera object continually captures frames
@@ -41,15 +187,26 @@ class IPCamera(object):
     functions detect_motion, detect_recognise, 
     motion_detect_recognise, segment_detect_recognise, 
     detect_recognise_track. These can be found in the 
-    SureveillanceSystem object, within the process_frame function"""
+    SureveillanceSystem object, within the process_frame function.
+    When sharedMemory is True frames are captured into shared memory
+    so that the camera can be processed by a CameraWorker process.
+    motionAnalysisWidth is the width frames are downsampled to for 
+    motion detection. zones are polygons that restrict processing
+    to part of the camera's view (see ZoneMask)"""
 
-    def __init__(self,camURL, cameraFunction, dlibDetection, fpsTweak):
+    def __init__(self,camURL, cameraFunction, dlibDetection, fpsTweak, sharedMemory=False,
+                 motionAnalysisWidth=MotionDetector.ANALYSIS_WIDTH, zones=None):
         logger.info("Loading Stream From IP Camera: " + camURL)
-        self.motionDetector = MotionDetector.MotionDetector()
+        self.motionDetector = MotionDetector.MotionDetector(analysisWidth=motionAnalysisWidth,
+                                                            clutterMapPath=MotionDetector.clutter_map_path(camURL))
+        self.zones = ZoneMask.ZoneMask(zones) # Include and exclude zones of the camera's view
+        self.motionDetector.set_zones(self.zones)
         self.faceDetector = FaceDetector.FaceDetector()
-        self.processing_frame = None
-        self.tempFrame = None
-        self.captureFrame  = None
+        self.processedLock = threading.Lock()
+        self.newProcessedFrame = threading.Condition(self.processedLock) # Notified every time a processed frame is published
+        self.processedSeq = 0 # Incremented every time a processed frame is published
+        self._processingFrame = None
+        self.worker = None # CameraWorker processing this camera in another process, if any
         self.streamingFPS = 0 # Streaming frame rate per second
         self.processingFPS = 0
         self.FPSstart = time.time()
@@ -62,8 +219,6 @@ class IPCamera(object):
         self.fpsTweak = fpsTweak # used to know if we should apply the FPS work around when you have many cameras
         self.rgbFrame = None
         self.faceBoxes = None
-        self.captureEvent = threading.Event()
-        self.captureEvent.set()
         self.peopleDictLock = threading.Lock() # Used to block concurrent access to people dictionary
         uri = camURL
         latency = 100
@@ -79,17 +234,50 @@ class IPCamera(object):
         self.url = camURL
         logger.info("Video feed open.")
         self.dump_video_info()  # logging every specs of the video feed
+        self.sharedMemory = sharedMemory
+        if sharedMemory:
+            frameWidth = int(self.video.get(cv2.CAP_PROP_FRAME_WIDTH)) or width
+            frameHeight = int(self.video.get(cv2.CAP_PROP_FRAME_HEIGHT)) or height
+            self.frameBuffer = SharedFrameBuffer((frameHeight, frameWidth, 3))
+        else:
+            self.frameBuffer = FrameBuffer() # Holds the most recently captured frames
         # Start a thread to continuously capture frames.
         # The capture thread ensures the frames being processed are up to date and are not old
         self.captureLock = threading.Lock() # Sometimes used to prevent concurrent access
         self.captureThread = threading.Thread(name='video_captureThread',target=self.get_frame)
         self.captureThread.daemon = True
-        self.captureThread.start()
         self.captureThread.stop = False
+        self.captureThread.start()
 
     def __del__(self):
         self.video.release()
 
+    def stop(self):
+        """Stops the capture thread, which releases the shared frame
+        buffer once it has written its last frame. The camera's
+        processing thread or worker must be stopped first"""
+        self.captureThread.stop = True
+        self.captureThread.join(CAPTURE_STOP_TIMEOUT)
+        if self.captureThread.is_alive():
+            logger.warning("Capture thread of " + self.url + " is still reading, its frame buffer is released when it stops")
+
+    def remove_person(self, key):
+        """Removes a detected person, the removal is forwarded to 
+        the camera's worker process if it has one"""
+        with self.peopleDictLock:
+            del self.people[key]
+        if self.worker is not None:
+            self.worker.remove_person(key)
+
+    def set_zones(self, zones):
+        """Replaces the camera's zones, raises ValueError if they are 
+        malformed. The zones are forwarded to the camera's worker 
+        process if it has one"""
+        self.zones = ZoneMask.ZoneMask(zones)
+        self.motionDetector.set_zones(self.zones)
+        if self.worker is not None:
+            self.worker.set_zones(self.zones.zones)
+
     def get_frame(self):
         logger.debug('Getting Frames')
         FPScount = 0
@@ -97,12 +285,11 @@ class IPCamera(object):
         #fpsTweak = 0  # set that to 1 if you want to enable Brandon's fps tweak. that break most video feeds so recommend not to
         FPSstart = time.time()
 
-        while True:
-            success, frame = self.video.read()
-            self.captureEvent.clear() 
+        while not self.captureThread.stop:
+            # Decode straight into a preallocated slot, read() only allocates if the slot is empty or the wrong size
+            success, frame = self.video.read(self.frameBuffer.writable_slot())
             if success:        
-                self.captureFrame  = frame
-                self.captureEvent.set() 
+                self.frameBuffer.commit(frame)
 
             FPScount += 1 
 
@@ -118,34 +305,79 @@ class IPCamera(object):
                     else:
                         time.sleep(self.streamingFPS/(CAPTURE_HZ*CAPTURE_HZ))
 
+        if self.sharedMemory: # The camera was removed, nothing writes to the buffer any more
+            self.frameBuffer.close()
+
+    @property
+    def processing_frame(self):
+        return self._processingFrame
+
+    @processing_frame.setter
+    def processing_frame(self, frame):
+        """Publishes a processed frame and wakes up any streams 
+        waiting for one"""
+        with self.processedLock:
+            self._processingFrame = frame
+            if frame is not None:
+                self.processedSeq += 1
+                self.newProcessedFrame.notify_all()
+
     def read_jpg(self):
         """We are using Motion JPEG, and OpenCV captures raw images,
         so we must encode it into JPEG in order to stream frames to
         the client. It is nessacery to make the image smaller to
         improve streaming performance"""
 
-        capture_blocker = self.captureEvent.wait()  
-        frame = self.captureFrame     
+        seq, jpeg = self.read_jpg_after(0)
+        while jpeg is None: # Wait until the first frame has been captured
+            seq, jpeg = self.read_jpg_after(0)
+        return jpeg
+
+    def read_jpg_after(self, seq, timeout=FRAME_WAIT_TIMEOUT):
+        """Blocks until a frame newer than seq has been captured 
+        and returns (seq, jpeg), or (seq, None) on timeout"""
+        seq, frame = self.read_frame_after(seq, timeout)
+        if frame is None:
+            return seq, None
         frame = ImageUtils.resize_mjpeg(frame)
         ret, jpeg = cv2.imencode('.jpg', frame)
-        return jpeg.tostring()
+        return seq, jpeg.tostring()
 
     def read_frame(self):
-        capture_blocker = self.captureEvent.wait()  
-        frame = self.captureFrame     
+        seq, frame = self.read_frame_after(0)
+        while frame is None: # Wait until the first frame has been captured
+            seq, frame = self.read_frame_after(0)
         return frame
 
+    def read_frame_after(self, seq, timeout=FRAME_WAIT_TIMEOUT):
+        """Blocks until a frame newer than the frame numbered seq 
+        has been captured and returns (seq, frame), or (seq, None)
+        if no new frame was captured within timeout"""
+        seq, timestamp, frame = self.frameBuffer.wait_after(seq, timeout)
+        return seq, frame
+
     def read_processed(self):
-        frame = None
-        with self.captureLock:
-            frame = self.processing_frame    
-        while (frame is None): # If there are problems, keep retrying until an image can be read.
-            with self.captureLock:    
-                frame = self.processing_frame
+        seq, jpeg = self.read_processed_after(0)
+        while jpeg is None: # Wait until the first frame has been processed
+            seq, jpeg = self.read_processed_after(0)
+        return jpeg
+
+    def read_processed_after(self, seq, timeout=FRAME_WAIT_TIMEOUT):
+        """Blocks until a processed frame newer than seq has been 
+        published and returns (seq, jpeg), or (seq, None) on timeout.
+        A seq of 0 returns the current processed frame if there is one"""
+        with self.processedLock:
+            if seq == 0 and self._processingFrame is not None:
+                seq = self.processedSeq - 1
+            self.newProcessedFrame.wait_for(lambda: self.processedSeq > seq, timeout)
+            if self.processedSeq <= seq or self._processingFrame is None:
+                return seq, None
+            seq = self.processedSeq
+            frame = self._processingFrame
 
         frame = ImageUtils.resize_mjpeg(frame)
         ret, jpeg = cv2.imencode('.jpg', frame)
-        return jpeg.tostring()
+        return seq, jpeg.tostring()
 
     def dump_video_info(self):
         logger.info("---------Dumping video feed info---------------------")
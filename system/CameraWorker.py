@@ -0,0 +1,240 @@
+# CameraWorker.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import threading
+import pickle
+import queue
+import time
+import os
+import logging
+import cv2
+import torch
+import Camera
+import ZoneMask
+
+logger = logging.getLogger(__name__)
+
+PEOPLE_SYNC_INTERVAL = 1.0 # Seconds between snapshots of a worker's detected people sent to the main process
+STATE_WAIT_TIMEOUT = 1.0 # Seconds the relay threads wait for worker updates before checking if they should stop
+
+class CameraWorker(object):
+    """The CameraWorker object runs SurveillanceSystem.process_frame
+    for one camera in a forked process, so that motion filtering,
+    face detection and recognition of different cameras no longer
+    contend for the GIL. Captured frames reach the worker through the
+    camera's SharedFrameBuffer and processed frames come back through
+    a second SharedFrameBuffer. Motion, frame rate and detected people
+    are relayed back over a queue so the main process can keep serving
+    the WebApp and alerts from the camera object as before. The
+    recogniser is inherited from the main process, the detection models
+    of the ModelRegistry are loaded by each worker the first time it
+    uses them. This mode is intended for CPU inference"""
+
+    def __init__(self, system, camera):
+        if not camera.sharedMemory:
+            raise ValueError("Camera must capture into shared memory to be processed by a worker")
+        self.camera = camera
+        height, width = camera.frameBuffer.shape[:2]
+        processedHeight = int(height * 640.0 / width) # Processed frames are resized by ImageUtils.resize
+        self.processedBuffer = Camera.SharedFrameBuffer((processedHeight, 640, 3))
+        context = multiprocessing.get_context('fork') # Workers inherit the shared buffers and the recogniser
+        self.stateQueue = context.Queue() # Worker -> main process updates
+        self.commandQueue = context.Queue() # Main process -> worker commands
+        self.embeddingCache = None # Latest stats of the worker recogniser's EmbeddingCache
+        self.stopped = False
+        self.process = context.Process(name='frame_process_worker_' + camera.url,
+                                       target=self._run,
+                                       args=(system,))
+        self.process.daemon = True
+        self.process.start()
+        camera.worker = self
+
+        self.frameRelayThread = threading.Thread(name='worker_frame_relay_thread_', target=self.relay_frames)
+        self.frameRelayThread.daemon = True
+        self.frameRelayThread.start()
+        self.stateRelayThread = threading.Thread(name='worker_state_relay_thread_', target=self.relay_state)
+        self.stateRelayThread.daemon = True
+        self.stateRelayThread.start()
+
+    def _run(self, system):
+        """Entry point of the worker process. The cores are split
+        between the workers so their inference threads do not
+        oversubscribe them"""
+        threads = max(1, (os.cpu_count() or 1) // max(1, len(system.cameras)))
+        torch.set_num_threads(threads)
+        cv2.setNumThreads(threads)
+        logger.info("Camera worker started for " + self.camera.url + " pid " + str(os.getpid()) + " with " + str(threads) + " threads")
+        workerCamera = WorkerCamera(self.camera, self.processedBuffer, self.stateQueue, self.commandQueue, system.recogniser)
+        system.process_frame(workerCamera)
+
+    def relay_frames(self):
+        """Publishes frames processed by the worker on the camera
+        so that streams waiting on the camera are woken up"""
+        seq = 0
+        while not self.stopped:
+            seq, timestamp, frame = self.processedBuffer.wait_after(seq, STATE_WAIT_TIMEOUT)
+            if frame is not None:
+                self.camera.processing_frame = frame.copy() # The worker reuses the slot a few frames later
+
+    def relay_state(self):
+        """Applies motion, frame rate, people and embedding cache updates
+        sent by the worker"""
+        while not self.stopped:
+            try:
+                key, value = self.stateQueue.get(timeout=STATE_WAIT_TIMEOUT)
+            except queue.Empty:
+                continue
+            if key == 'motion':
+                self.camera.motion = value
+            elif key == 'processingFPS':
+                self.camera.processingFPS = value
+            elif key == 'people':
+                people = pickle.loads(value)
+                with self.camera.peopleDictLock:
+                    self.camera.people = people
+            elif key == 'embeddingCache':
+                self.embeddingCache = value
+
+    def remove_person(self, key):
+        self.commandQueue.put(('remove_person', key))
+
+    def set_zones(self, zones):
+        self.commandQueue.put(('set_zones', zones))
+
+    def reload_classifier(self, path):
+        """The worker's FaceRecogniser is a copy made when it was forked,
+        a retrained classifier is swapped into it too"""
+        self.commandQueue.put(('reload_classifier', path))
+
+    def reload_gallery(self):
+        """Reloads the gallery after a face was enrolled in the main process"""
+        self.commandQueue.put(('reload_gallery', None))
+
+    def set_quantized(self, quantized):
+        """Switches the worker's recogniser to the int8 or float network"""
+        self.commandQueue.put(('set_quantized', quantized))
+
+    def stop(self):
+        self.stopped = True
+        self.process.terminate()
+        self.process.join()
+        self.processedBuffer.close()
+        self.camera.worker = None
+
+class WorkerCamera(object):
+    """Stands in for an IPCamera inside a worker process. It reads
+    frames from the camera's shared buffer, writes processed frames
+    to the worker's shared buffer and reports state changes that the
+    main process needs for streaming and alerts. Commands sent by the
+    main process are applied to the camera and to the worker's copy of
+    the FaceRecogniser"""
+
+    def __init__(self, camera, processedBuffer, stateQueue, commandQueue, recogniser):
+        self.url = camera.url
+        self.frameBuffer = camera.frameBuffer
+        self.processedBuffer = processedBuffer
+        self.stateQueue = stateQueue
+        self.commandQueue = commandQueue
+        self.recogniser = recogniser
+        self.captureThread = camera.captureThread # Only used for its stop flag
+        self.motionDetector = camera.motionDetector
+        self.zones = camera.zones
+        self.faceDetector = camera.faceDetector
+        self.cameraFunction = camera.cameraFunction
+        self.dlibDetection = camera.dlibDetection
+        self.fpsTweak = camera.fpsTweak
+        self.people = {}
+        self.trackers = []
+        self.rgbFrame = None
+        self.faceBoxes = None
+        self.peopleDictLock = threading.Lock()
+        self._motion = False
+        self._processingFPS = 0
+        self._processingFrame = None
+        self.peopleSyncTime = time.time()
+
+    @property
+    def motion(self):
+        return self._motion
+
+    @motion.setter
+    def motion(self, motion):
+        if motion != self._motion:
+            self.stateQueue.put(('motion', motion))
+        self._motion = motion
+
+    @property
+    def processingFPS(self):
+        return self._processingFPS
+
+    @processingFPS.setter
+    def processingFPS(self, fps):
+        self._processingFPS = fps
+        self.stateQueue.put(('processingFPS', fps))
+
+    @property
+    def processing_frame(self):
+        return self._processingFrame
+
+    @processing_frame.setter
+    def processing_frame(self, frame):
+        self._processingFrame = frame
+        if frame is not None:
+            self.processedBuffer.commit(frame)
+        if time.time() - self.peopleSyncTime > PEOPLE_SYNC_INTERVAL:
+            self.sync_people()
+
+    def sync_people(self):
+        """Sends a snapshot of the detected people to the main process,
+        pickled under the lock so it is consistent, along with the stats
+        of the worker's embedding cache"""
+        with self.peopleDictLock:
+            people = pickle.dumps(self.people)
+        self.stateQueue.put(('people', people))
+        self.stateQueue.put(('embeddingCache', self.recogniser.cache.stats()))
+        self.peopleSyncTime = time.time()
+
+    def read_frame_after(self, seq, timeout=Camera.FRAME_WAIT_TIMEOUT):
+        self.run_commands()
+        seq, timestamp, frame = self.frameBuffer.wait_after(seq, timeout)
+        return seq, frame
+
+    def run_commands(self):
+        while True:
+            try:
+                command, argument = self.commandQueue.get_nowait()
+            except queue.Empty:
+                return
+            if command == 'remove_person':
+                with self.peopleDictLock:
+                    self.people.pop(argument, None)
+            elif command == 'set_zones':
+                self.zones = ZoneMask.ZoneMask(argument)
+                self.motionDetector.set_zones(self.zones)
+            elif command == 'reload_classifier':
+                try:
+                    self.recogniser.reloadClassifier(argument)
+                except Exception as e:
+                    logger.error("Camera worker " + self.url + " could not load " + str(argument) + ": " + str(e))
+            elif command == 'reload_gallery':
+                try:
+                    self.recogniser.reload_gallery()
+                except Exception as e:
+                    logger.error("Camera worker " + self.url + " could not reload the gallery: " + str(e))
+            elif command == 'set_quantized':
+                try:
+                    self.recogniser.set_quantized(argument)
+                except Exception as e:
+                    logger.error("Camera worker " + self.url + " could not switch the embedding network: " + str(e))
@@ -0,0 +1,126 @@
+# EmbeddingCache.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+import cv2
+import numpy as np
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = 256 # Predictions kept, 0 disables the cache
+CACHE_TTL = 5.0 # Seconds a prediction is reused for
+FINGERPRINT_SIZE = 16 # The fingerprint compares 16x16 neighbouring pixels, 256 bits
+FINGERPRINT_DISTANCE = 8 # Differing fingerprint bits of faces treated as the same face
+
+def fingerprint(alignedFace):
+    """A difference hash of an aligned face, one bit per pixel of a
+    16x16 thumbnail that is brighter than its right neighbour. It
+    ignores small changes of brightness and sensor noise between frames
+    but changes when the face turns or someone else is aligned"""
+    gray = cv2.cvtColor(alignedFace, cv2.COLOR_BGR2GRAY)
+    thumbnail = cv2.resize(gray, (FINGERPRINT_SIZE + 1, FINGERPRINT_SIZE), interpolation=cv2.INTER_AREA)
+    bits = thumbnail[:, 1:] > thumbnail[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def combine_stats(statsList):
+    """Sums the stats() of several caches, i.e those of the camera
+    worker processes, and recomputes the hit rate"""
+    combined = {'size': 0, 'hits': 0, 'misses': 0, 'savedSeconds': 0.0}
+    for stats in statsList:
+        for key in combined:
+            combined[key] += stats[key]
+    lookups = combined['hits'] + combined['misses']
+    combined['hitRate'] = combined['hits'] / lookups if lookups else 0.0
+    return combined
+
+class EmbeddingCache(object):
+    """The EmbeddingCache holds the predictions of recently recognised
+    faces, so a person standing still in front of a camera is embedded
+    and classified once instead of on every frame. Predictions are
+    keyed by the camera a face was seen by and the fingerprint of the
+    aligned face, a lookup matches any face of that camera whose
+    fingerprint differs by at most FINGERPRINT_DISTANCE bits. The least
+    recently used prediction is dropped when the cache is full, and
+    predictions older than ttl seconds are never reused. Hits, misses
+    and the recognition time saved by hits are counted for monitoring"""
+
+    def __init__(self, capacity=CACHE_SIZE, ttl=CACHE_TTL, maxDistance=FINGERPRINT_DISTANCE):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.maxDistance = maxDistance
+        self.entries = OrderedDict() # (location, fingerprint) -> (persondict, time), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.recognised = 0 # Faces that missed and were then recognised and cached
+        self.recognitionTime = 0.0 # Seconds spent recognising them
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, location, key):
+        """Returns the cached persondict of a face, None on a miss"""
+        if self.capacity <= 0:
+            return None
+        now = time.time()
+        with self.lock:
+            match = None
+            expired = []
+            for entryKey, (persondict, stored) in self.entries.items():
+                if now - stored > self.ttl:
+                    expired.append(entryKey)
+                elif entryKey[0] == location and bin(entryKey[1] ^ key).count('1') <= self.maxDistance:
+                    match = entryKey
+                    if entryKey[1] == key:
+                        break
+            for entryKey in expired:
+                del self.entries[entryKey]
+            if match is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(match)
+            self.hits += 1
+            return dict(self.entries[match][0])
+
+    def put(self, location, key, persondict, seconds):
+        """Caches the persondict of a face that took seconds to recognise"""
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.recognised += 1
+            self.recognitionTime += seconds
+            self.entries[(location, key)] = (dict(persondict), time.time())
+            self.entries.move_to_end((location, key))
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drops every prediction, i.e when the classifier changes"""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Returns the hit rate and the recognition time saved by hits,
+        estimated from the average time of a miss"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            average = self.recognitionTime / self.recognised if self.recognised else 0.0
+            return {'size': len(self.entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hitRate': self.hits / lookups if lookups else 0.0,
+                    'savedSeconds': self.hits * average}
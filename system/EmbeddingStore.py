@@ -0,0 +1,98 @@
+# EmbeddingStore.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import struct
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HSEMBED\0'
+VERSION = 1
+HEADER_SIZE = 64 # magic, version, count, dim, metadata length, padded so the sections stay aligned
+HEADER_FORMAT = '<8sIIIQ'
+ALIGNMENT = 64
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+class EmbeddingStore(object):
+    """The EmbeddingStore holds the training embeddings in a single
+    binary file that is memory mapped when loaded, so it is read with
+    no parsing at all. The file holds a fixed size header, an int32
+    label per embedding, the float32 embedding matrix and a json
+    metadata block with the label names and the file each embedding
+    was generated from. Files are written to a temporary file and
+    renamed into place, so readers never see a partial store"""
+
+    def __init__(self, embeddings, labels, names, metadata=None):
+        self.embeddings = embeddings # count x dim float32, memory mapped when loaded from disk
+        self.labels = labels # Index into names for every embedding
+        self.names = names
+        self.metadata = metadata if metadata is not None else {}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def label_names(self):
+        """Returns the name of every embedding's label"""
+        return [self.names[label] for label in self.labels]
+
+    @staticmethod
+    def write(path, embeddings, labels, names, metadata=None):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        labels = np.asarray(labels, dtype=np.int32)
+        count, dim = embeddings.shape
+        meta = dict(metadata if metadata is not None else {})
+        meta['names'] = list(names)
+        metaBytes = json.dumps(meta).encode('utf-8')
+
+        labelsOffset = HEADER_SIZE
+        matrixOffset = _align(labelsOffset + labels.nbytes)
+        metaOffset = matrixOffset + embeddings.nbytes
+
+        tmpPath = path + ".tmp"
+        with open(tmpPath, 'wb') as f:
+            f.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, count, dim, len(metaBytes)).ljust(HEADER_SIZE, b'\0'))
+            f.write(labels.tobytes())
+            f.write(b'\0' * (matrixOffset - labelsOffset - labels.nbytes))
+            f.write(embeddings.tobytes())
+            f.write(metaBytes)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, path)
+        logger.info("Wrote {} embeddings of {} people to {}".format(count, len(names), path))
+
+    @staticmethod
+    def load(path):
+        """Memory maps a store, returns None if there is no store at path"""
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            magic, version, count, dim, metaLength = struct.unpack(HEADER_FORMAT, f.read(struct.calcsize(HEADER_FORMAT)))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("{} is not an embedding store".format(path))
+            labelsOffset = HEADER_SIZE
+            matrixOffset = _align(labelsOffset + 4 * count)
+            metaOffset = matrixOffset + 4 * count * dim
+            f.seek(metaOffset)
+            metadata = json.loads(f.read(metaLength).decode('utf-8'))
+
+        if count == 0:
+            return EmbeddingStore(np.zeros((0, dim), dtype=np.float32), np.zeros(0, dtype=np.int32), metadata.pop('names'), metadata)
+        labels = np.memmap(path, dtype=np.int32, mode='r', offset=labelsOffset, shape=(count,))
+        embeddings = np.memmap(path, dtype=np.float32, mode='r', offset=matrixOffset, shape=(count, dim))
+        return EmbeddingStore(embeddings, labels, metadata.pop('names'), metadata)
@@ -24,6 +24,7 @@ import logging
 #import ImageUtils
 import time
 import numpy as np
+import ModelRegistry
 
 if dlib.cuda.get_num_devices()>0:
     print("FaceDetector DLIB using CUDA")
@@ -35,24 +36,33 @@ configFile = "models/opencv_face_detector.pbtxt"
 accurate_modelFile = "models/res10_300x300_ssd_iter_140000_fp16.caffemodel"
 accurate_configFile = "models/deploy.prototxt"
 
+CONFIDENCE_THRESHOLD = 0.9 # Minimum confidence of an SSD face detection
+NMS_THRESHOLD = None # Overlap above which weaker SSD detections are suppressed, None disables suppression
+
+def load_ssd():
+    net = cv2.dnn.readNetFromTensorflow(modelFile, configFile)
+    net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
+    net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
+    return net
+
+def load_accurate_ssd():
+    net = cv2.dnn.readNetFromCaffe(accurate_configFile, accurate_modelFile)
+    net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
+    net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
+    return net
+
+ModelRegistry.models.register('ssd', load_ssd)
+ModelRegistry.models.register('ssd_accurate', load_accurate_ssd)
+ModelRegistry.models.register('dlib_hog', dlib.get_frontal_face_detector)
+
 class FaceDetector(object):
-    """This class implements both OpenCV's Haar Cascade
-    detector and Dlib's HOG based face detector"""
+    """This class implements both OpenCV's SSD face detector and
+    Dlib's HOG based face detector. The models are shared by every
+    camera through the process wide ModelRegistry and loaded the first 
+    time they are used, so creating a FaceDetector is cheap"""
 
     def __init__(self):
-        self.facecascade = cv2.CascadeClassifier("models/haarcascade_frontalface_alt2.xml")
-        self.facecascade2 = cv2.CascadeClassifier("models/haarcascade_frontalface_alt2.xml")
-        self.detector = dlib.get_frontal_face_detector()
-        self.net = cv2.dnn.readNetFromTensorflow(modelFile, configFile)
-        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
-        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
-        self.acc_net = cv2.dnn.readNetFromCaffe(accurate_configFile, accurate_modelFile)
-        self.acc_net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
-        self.acc_net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
-        
-        self.cascade_lock = threading.Lock()
-        self.accurate_cascade_lock = threading.Lock()
-
+        self.models = ModelRegistry.models
 
     def detect_faces(self, image, dlibDetector):
          if dlibDetector:
@@ -72,28 +82,55 @@ class FaceDetector(object):
          return cl1
 
     def detect_dnn_face(self, image, accurate=False):
-        start = time.time()
-        frameHeight, frameWidth, channels = image.shape
-        blob = cv2.dnn.blobFromImage(image, 1.0, (300, 300), [104, 117, 123], False, False)
-        if accurate:
-            self.acc_net.setInput(blob)
-            detections = self.acc_net.forward()
-        else:
-            self.net.setInput(blob)
-            detections = self.net.forward()
-        bboxes = []
-        confidence = 0
-        for i in range(detections.shape[2]):
-            confidence = detections[0, 0, i, 2]
-            if confidence > 0.9:
-                x1 = int(detections[0, 0, i, 3] * frameWidth)
-                y1 = int(detections[0, 0, i, 4] * frameHeight)
-                x2 = int(detections[0, 0, i, 5] * frameWidth)
-                y2 = int(detections[0, 0, i, 6] * frameHeight)
-                #r = dlib.rectangle(x1,y1,x2,y2)
-                r = (x1, y1, x2-x1, y2-y1)
-                bboxes.append(r)
-        return bboxes
+        return self.detect_dnn_faces([image], accurate)[0]
+
+    def detect_dnn_faces(self, images, accurate=False):
+        """Runs the SSD face detector on several images with one 
+        forward pass, returns an Nx4 array of (x, y, w, h) boxes per image"""
+        blob = cv2.dnn.blobFromImages(images, 1.0, (300, 300), [104, 117, 123], False, False)
+        with self.models.using('ssd_accurate' if accurate else 'ssd') as net: # One forward pass per batch, serialised across cameras
+            net.setInput(blob)
+            detections = net.forward()
+        sizes = [image.shape[:2] for image in images]
+        return self.detection_boxes(detections, sizes)
+
+    def detection_boxes(self, detections, sizes, nmsThreshold=NMS_THRESHOLD):
+        """Maps the SSD's detections back to the images they were found
+        in, the first column of a detection holds its image's index. 
+        Returns an Nx4 int32 array of (x, y, w, h) boxes per image, 
+        clipped to the image. Overlapping boxes of the same image are
+        suppressed if an nmsThreshold is given"""
+        detections = detections.reshape(-1, 7)
+        detections = detections[detections[:, 2] > CONFIDENCE_THRESHOLD]
+        indices = detections[:, 0].astype(np.intp)
+        sizes = np.array(sizes, dtype=np.float32).reshape(-1, 2) # height, width of every image
+        bounds = sizes[indices][:, [1, 0, 1, 0]] # width, height, width, height of each detection's image
+        corners = np.clip(detections[:, 3:7], 0.0, 1.0) * bounds
+        boxes = corners.astype(np.int32) # x1, y1, x2, y2
+        boxes[:, 2:] -= boxes[:, :2] # x, y, w, h
+        valid = (boxes[:, 2] > 0) & (boxes[:, 3] > 0)
+        boxes, indices, scores = boxes[valid], indices[valid], detections[valid, 2]
+
+        imageBoxes = []
+        for i in range(len(sizes)):
+            found = indices == i
+            imageBox = boxes[found]
+            # Boxes are in their own image's coordinates, so only boxes of the same image suppress each other
+            if nmsThreshold is not None and len(imageBox) > 1:
+                keep = cv2.dnn.NMSBoxes(imageBox.tolist(), scores[found].tolist(), CONFIDENCE_THRESHOLD, nmsThreshold)
+                imageBox = imageBox[np.array(keep, dtype=np.intp).reshape(-1)]
+            imageBoxes.append(imageBox)
+        return imageBoxes
+
+    def detect_faces_batch(self, images, dlibDetector=False):
+        """Detects faces in several images, i.e the motion regions of 
+        one or more cameras, returns a list of face boxes per image. 
+        The SSD processes all images in a single forward pass"""
+        if len(images) == 0:
+            return []
+        if dlibDetector:
+            return [self.detect_dlib_face(image) for image in images]
+        return self.detect_dnn_faces(images)
         
     
     def rgb_pre_processing(self,image):
@@ -116,7 +153,8 @@ class FaceDetector(object):
     def detect_dlib_face(self,image):
         # rgbFrame = rgb_pre_processing(rgbFrame)
         image = self.pre_processing(image)
-        bbs = self.detector(image, 1)
+        with self.models.using('dlib_hog') as detector:
+            bbs = detector(image, 1)
         # bbs = []
         # dets, scores, idx = self.detector.run(image, 1, -1)
         # for i, d in enumerate(dets):
@@ -132,16 +170,15 @@ class FaceDetector(object):
 
     def detect_cascade_face(self,image):
         #print(">detect_cascadeface")
-        with self.cascade_lock:  # Used to block simultaneous access to resource, stops segmentation fault when using more than one camera
-            #image = self.pre_processing(image)
-            #rects = self.facecascade.detectMultiScale(image, scaleFactor=1.25, minNeighbors=3, minSize=(20, 20), flags = cv2.CASCADE_SCALE_IMAGE)
-            rects = self.detect_dnn_face(image, False)
+        # The shared net is locked while it runs, which stops concurrent access when using more than one camera
+        #image = self.pre_processing(image)
+        #rects = self.facecascade.detectMultiScale(image, scaleFactor=1.25, minNeighbors=3, minSize=(20, 20), flags = cv2.CASCADE_SCALE_IMAGE)
+        rects = self.detect_dnn_face(image, False)
         return rects
 
     def detect_cascadeface_accurate(self,image):
         """Used to help mitigate false positive detections"""
         print(">detect_cascadeface_accurate")
-        with self.accurate_cascade_lock:
-            #rects = self.facecascade2.detectMultiScale(img, scaleFactor=1.02, minNeighbors=12, minSize=(20, 20), flags = cv2.CASCADE_SCALE_IMAGE)
-            rects = self.detect_dnn_face(image, True)
+        #rects = self.facecascade2.detectMultiScale(img, scaleFactor=1.02, minNeighbors=12, minSize=(20, 20), flags = cv2.CASCADE_SCALE_IMAGE)
+        rects = self.detect_dnn_face(image, True)
         return rects
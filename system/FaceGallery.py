@@ -0,0 +1,122 @@
+# FaceGallery.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import threading
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIM = 128
+SAME_PERSON_DISTANCE = 0.99 # Openface found 0.99 squared l2 distance to be the average cutoff between the same and different faces
+
+class FaceGallery(object):
+    """The FaceGallery is a nearest neighbour alternative to the SVM
+    classifier. Enrolled embeddings are kept in one contiguous float32
+    matrix together with a unit length centroid per identity, so a
+    face is matched against every identity with a single matrix-vector
+    product and new people can be enrolled without retraining. The
+    confidence of a match is 100 for identical embeddings and falls to
+    50 at SAME_PERSON_DISTANCE, so it can be compared against the
+    system's confidenceThreshold like the SVM's probabilities"""
+
+    def __init__(self, dim=EMBEDDING_DIM):
+        self.dim = dim
+        self.embeddings = np.zeros((64, dim), dtype=np.float32) # Grown by doubling, only the first count rows are used
+        self.labels = np.zeros(64, dtype=np.int32) # Identity index of each enrolled embedding
+        self.count = 0
+        self.names = [] # Identity index -> name
+        self.nameIndex = {} # Name -> identity index
+        self.sums = np.zeros((0, dim), dtype=np.float64) # Running sum of each identity's embeddings
+        self.identities = ([], np.zeros((0, dim), dtype=np.float32)) # (names, centroids) read by matching
+        self.lock = threading.Lock() # Serialises enrollment, matching reads identities without locking
+
+    def __len__(self):
+        return len(self.identities[0])
+
+    def enroll(self, name, reps):
+        """Adds one or more embeddings (Nx128) of a person and
+        updates only that person's centroid"""
+        reps = np.asarray(reps, dtype=np.float32).reshape(-1, self.dim)
+        with self.lock:
+            if name not in self.nameIndex:
+                self.nameIndex[name] = len(self.names)
+                self.names.append(name)
+                self.sums = np.vstack([self.sums, np.zeros((1, self.dim))])
+            identity = self.nameIndex[name]
+
+            while self.count + len(reps) > len(self.embeddings):
+                self.embeddings = np.concatenate([self.embeddings, np.zeros_like(self.embeddings)])
+                self.labels = np.concatenate([self.labels, np.zeros_like(self.labels)])
+            self.embeddings[self.count:self.count + len(reps)] = reps
+            self.labels[self.count:self.count + len(reps)] = identity
+            self.count += len(reps)
+
+            self.sums[identity] += reps.sum(axis=0)
+            self.update_centroids()
+
+    def update_centroids(self):
+        norms = np.linalg.norm(self.sums, axis=1, keepdims=True)
+        centroids = (self.sums / np.maximum(norms, 1e-12)).astype(np.float32)
+        self.identities = (list(self.names), centroids) # Swapped in one assignment so matching never pairs a centroid with the wrong name
+
+    def build(self, embeddings, names):
+        """Replaces the gallery with the given embeddings, one name per
+        row. All identity sums are accumulated in one pass and every
+        centroid is normalised once"""
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        identities, labels = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+        count = len(embeddings)
+        capacity = max(64, count)
+        allEmbeddings = np.zeros((capacity, self.dim), dtype=np.float32)
+        allEmbeddings[:count] = embeddings
+        allLabels = np.zeros(capacity, dtype=np.int32)
+        allLabels[:count] = labels.reshape(-1)
+        sums = np.zeros((len(identities), self.dim), dtype=np.float64)
+        np.add.at(sums, allLabels[:count], embeddings)
+        names = [str(name) for name in identities]
+        with self.lock:
+            self.embeddings, self.labels, self.count = allEmbeddings, allLabels, count
+            self.names, self.nameIndex, self.sums = names, {name: i for i, name in enumerate(names)}, sums
+            self.update_centroids()
+
+    def match(self, reps):
+        """Matches Nx128 embeddings against every identity, returns
+        a list of names and a list of confidences (0-100)"""
+        names, centroids = self.identities
+        reps = np.asarray(reps, dtype=np.float32).reshape(-1, self.dim)
+        if len(centroids) == 0:
+            return ["unknown"] * len(reps), [0] * len(reps)
+        similarities = np.dot(reps, centroids.T)
+        best = np.argmax(similarities, axis=1)
+        distances = 2.0 - 2.0 * similarities[np.arange(len(reps)), best] # Squared l2 distance between unit vectors
+        confidences = np.clip(100.0 * (1.0 - distances / (2.0 * SAME_PERSON_DISTANCE)), 0, 100)
+        return [names[i] for i in best], [int(np.ceil(c)) for c in confidences]
+
+    def save(self, path):
+        with self.lock:
+            tmpPath = path + ".tmp.npz"
+            np.savez(tmpPath,
+                     embeddings=self.embeddings[:self.count],
+                     labels=self.labels[:self.count],
+                     names=np.array(self.names))
+            os.replace(tmpPath, path)
+
+    def load(self, path):
+        data = np.load(path)
+        names = [str(name) for name in data['names']]
+        embeddings = data['embeddings']
+        self.build(embeddings, [names[label] for label in data['labels']])
+        logger.info("Loaded face gallery of {} identities from {}".format(len(self.names), path))
@@ -32,6 +32,7 @@ import pickle
 import math
 import datetime
 import threading
+import queue
 import logging
 from sklearn.decomposition import PCA
 from sklearn.model_selection import GridSearchCV
@@ -44,18 +45,28 @@ from sklearn.preprocessing import LabelEncoder
 import atexit
 from subprocess import Popen, PIPE
 import os.path
-import numpy as np
-import pandas as pd
 import aligndlib
 import openface
+import FaceGallery
+import EmbeddingStore
+import EmbeddingCache
+import LinearSVMPredictor
 
 import torch
 import loadOpenFace  # https://github.com/thnkim/OpenFacePytorch
+import OpenFaceEngine
 
+import json
 import csv
+import hashlib
+from concurrent.futures import Future
 
 logger = logging.getLogger(__name__)
 
+EMBEDDING_BATCH_SIZE = 16 # Maximum number of aligned faces embedded in one forward pass
+EMBEDDING_BATCH_DEADLINE = 0.01 # Seconds the first face of a batch waits for other faces to join it
+CLASSIFIER_VERSIONS_KEPT = 2 # Versioned classifiers kept by train(), the current one and the one before it
+
 start = time.time()
 np.set_printoptions(precision=2)
 
@@ -65,6 +76,11 @@ dlibModelDir = os.path.join(modelDir, 'dlib')
 openfaceModelDir = os.path.join(modelDir, 'openface')
 alignedImgDir = os.path.join(fileDir, 'aligned-images')
 genEmbedDir =  os.path.join(fileDir, 'generated-embeddings')
+galleryPath = os.path.join(genEmbedDir, 'gallery.npz')
+classifierPath = os.path.join(genEmbedDir, 'classifier.pkl')
+storePath = os.path.join(genEmbedDir, 'embeddings.bin')
+legacyRepsPath = os.path.join(genEmbedDir, 'reps.npy') # Written with legacyLabelsPath before the EmbeddingStore
+legacyLabelsPath = os.path.join(genEmbedDir, 'labels.csv')
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--dlibFacePredictor', type=str, help="Path to dlib's face predictor.",
@@ -77,38 +93,141 @@ parser.add_argument('--cuda', action='store_true')
 parser.add_argument('--unknown', type=bool, default=False,
                     help='Try to predict unknown people')
 args = parser.parse_args()
-args.cuda = True
+args.cuda = args.cuda or torch.cuda.is_available() # Hosts without a GPU use the OpenFaceEngine
 
 if args.cuda and dlib.cuda.get_num_devices()>0:
     print("FaceRecogniser DLIB using CUDA")
     dlib.DLIB_USE_CUDA = True
 
+class EmbeddingBatcher(object):
+    """The EmbeddingBatcher gathers aligned faces submitted by all
+    camera processing threads into micro-batches bounded by 
+    EMBEDDING_BATCH_SIZE and EMBEDDING_BATCH_DEADLINE. Each batch is
+    embedded with one forward pass through the network and classified
+    with one classifier call, and every caller receives its own 
+    prediction through a Future"""
+
+    def __init__(self, recogniser, batchSize=EMBEDDING_BATCH_SIZE, deadline=EMBEDDING_BATCH_DEADLINE):
+        self.recogniser = recogniser
+        self.batchSize = batchSize
+        self.deadline = deadline
+        self.pid = None
+        self.start()
+
+    def start(self):
+        """Starts the batching thread. Threads do not survive a fork, 
+        so this is called again in CameraWorker processes"""
+        self.pid = os.getpid()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(name='embedding_batch_thread_', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, alignedFace):
+        """Queues an aligned face and returns a Future resolving to its persondict"""
+        if self.pid != os.getpid():
+            self.start()
+        future = Future()
+        self.requests.put((alignedFace, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()] # Block until there is work
+            deadline = time.time() + self.deadline
+            while len(batch) < self.batchSize:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            alignedFaces = [alignedFace for alignedFace, future in batch]
+            try:
+                with self.recogniser.neuralNetLock:
+                    persondicts = self.recogniser.recognize_faces(alignedFaces)
+            except Exception as e:
+                logger.error("Embedding batch of " + str(len(batch)) + " faces failed: " + str(e))
+                for alignedFace, future in batch:
+                    future.set_exception(e)
+                continue
+            logger.debug("Embedded batch of " + str(len(batch)) + " faces")
+            for (alignedFace, future), persondict in zip(batch, persondicts):
+                future.set_result(persondict)
+
 class FaceRecogniser(object):
     """This class implements face recognition using Openface's
     pretrained neural network and a Linear SVM classifier. Functions
     below allow a user to retrain the classifier and make predictions
-    on detected faces"""
+    on detected faces. When batchEmbeddings is True faces from all 
+    cameras are embedded together by an EmbeddingBatcher. When 
+    useGallery is True faces are matched against a FaceGallery 
+    of enrolled embeddings instead of the SVM. Predictions of faces 
+    a camera saw moments ago are reused from an EmbeddingCache"""
 
-    def __init__(self):
+    def __init__(self, batchEmbeddings=True, cacheSize=EmbeddingCache.CACHE_SIZE, cacheTTL=EmbeddingCache.CACHE_TTL):
         #self.net = openface.TorchNeuralNet(args.networkModel, imgDim=args.imgDim,cuda=args.cuda)
         self.net = loadOpenFace.prepareOpenFace(useCuda=args.cuda, gpuDevice=0, useMultiGPU=False).eval()
+        if not args.cuda:
+            self.net = OpenFaceEngine.OpenFaceEngine(self.net) # Traced, BatchNorm folded CPU inference
         
         self.align = openface.AlignDlib(args.dlibFacePredictor)
         self.neuralNetLock = threading.Lock()
+        self.quantized = False # Embed with an int8 network on the CPU, see set_quantized()
+        self.inputBatch = None # Preallocated network input, see input_batch()
         self.predictor = dlib.shape_predictor(args.dlibFacePredictor)
+        self.cache = EmbeddingCache.EmbeddingCache(cacheSize, cacheTTL) # Cleared whenever predictions would change
 
         logger.info("Opening classifier.pkl to load existing known faces db")
-        with open("generated-embeddings/classifier.pkl", 'rb') as f: # le = labels, clf = classifier
-            (self.le, self.clf) = pickle.load(f, encoding='bytes') # Loads labels and classifier SVM or GMM
+        self.load_classifier(classifierPath)
 
-    def make_prediction(self,rgbFrame,bb):
+        self.useGallery = False
+        self.gallery = FaceGallery.FaceGallery()
+        if os.path.isfile(galleryPath):
+            self.gallery.load(galleryPath)
+        else:
+            store = EmbeddingStore.EmbeddingStore.load(storePath) or self.migrate_legacy_embeddings()
+            if store is not None and len(store) > 0:
+                self.gallery.build(store.embeddings, store.label_names())
+            else:
+                logger.warning("There are no face embeddings in " + storePath + ", every face is unknown until the classifier is retrained")
+
+        self.batcher = EmbeddingBatcher(self) if batchEmbeddings else None
+
+    def set_quantized(self, quantized):
+        """Switches embedding between the float network and an int8
+        quantised one calibrated on the aligned training images. Only
+        CPU inference is quantised. The new network is swapped in under
+        neuralNetLock. The gallery and classifier keep the embeddings of
+        the float network, benchmark.py quantized reports how far int8
+        embeddings drift from them. quantized is only changed once the
+        new network is built, and reports what it actually runs"""
+        if quantized == self.quantized:
+            return
+        if args.cuda:
+            logger.info("The OpenFace network runs on the GPU and is not quantised")
+            return
+        model = loadOpenFace.prepareOpenFace(useCuda=False, gpuDevice=0, useMultiGPU=False).eval()
+        calibration = OpenFaceEngine.calibration_faces(alignedImgDir) if quantized else None
+        net = OpenFaceEngine.OpenFaceEngine(model, calibration=calibration)
+        with self.neuralNetLock:
+            self.net = net
+        self.quantized = net.quantized # The int8 build falls back to float if torch cannot quantise
+        self.cache.clear()
+        logger.info("Embedding with the " + ("int8" if net.quantized else "float") + " OpenFace network")
+
+    def make_prediction(self,rgbFrame,bb,location=None):
         """The function uses the location of a face
         to detect facial landmarks and perform an affine transform
         to align the eyes and nose to the correct positiion.
         The aligned face is passed through the neural net which
         generates 128 measurements which uniquly identify that face.
         These measurements are known as an embedding, and are used
-        by the classifier to predict the identity of the person"""
+        by the classifier to predict the identity of the person.
+        location names the camera the frame is from, the prediction
+        of a face it saw moments ago is reused if it is given"""
 
         landmarks = self.align.findLandmarks(rgbFrame, bb)
         if landmarks == None:
@@ -121,8 +240,7 @@ class FaceRecogniser(object):
             return None
 
         logger.info("////  FACE ALIGNED  // ")
-        with self.neuralNetLock :
-            persondict = self.recognize_face(alignedFace)
+        persondict = self.recognize_aligned([alignedFace], location)[0]
 
         if persondict is None:
             logger.info("/////  FACE COULD NOT BE RECOGNIZED  //")
@@ -131,6 +249,63 @@ class FaceRecogniser(object):
             logger.info("/////  FACE RECOGNIZED  /// ")
             return persondict, alignedFace
 
+    def make_predictions(self, rgbFrame, bbs, location=None):
+        """Batched make_prediction for all faces found in one frame. 
+        Landmarks and alignment are computed per face, then all 
+        aligned faces are embedded with a single forward pass and
+        classified with a single classifier call. Returns a list with
+        a (persondict, alignedFace) tuple per face, or None for faces
+        that could not be aligned. location is as in make_prediction"""
+
+        alignedFaces = []
+        for bb in bbs:
+            landmarks = self.align.findLandmarks(rgbFrame, bb)
+            if landmarks is None:
+                logger.info("///  FACE LANDMARKS COULD NOT BE FOUND  ///")
+                alignedFaces.append(None)
+                continue
+            alignedFace = self.align.align(args.imgDim, rgbFrame, bb,landmarks=landmarks,landmarkIndices=openface.AlignDlib.OUTER_EYES_AND_NOSE)
+            if alignedFace is None:
+                logger.info("///  FACE COULD NOT BE ALIGNED  ///")
+            alignedFaces.append(alignedFace)
+
+        faces = [alignedFace for alignedFace in alignedFaces if alignedFace is not None]
+        if not faces:
+            return alignedFaces
+
+        persondicts = iter(self.recognize_aligned(faces, location))
+        return [(next(persondicts), alignedFace) if alignedFace is not None else None for alignedFace in alignedFaces]
+
+    def recognize_aligned(self, alignedFaces, location=None):
+        """Returns a persondict per aligned face. If location is given
+        cached predictions are reused for faces it saw moments ago, the
+        other faces are embedded together, through the EmbeddingBatcher
+        if there is one, and cached"""
+        persondicts = [None] * len(alignedFaces)
+        keys = [None] * len(alignedFaces)
+        if location is not None:
+            for i, alignedFace in enumerate(alignedFaces):
+                keys[i] = EmbeddingCache.fingerprint(alignedFace)
+                persondicts[i] = self.cache.get(location, keys[i])
+        misses = [i for i in range(len(alignedFaces)) if persondicts[i] is None]
+        if not misses:
+            return persondicts
+
+        start = time.time()
+        faces = [alignedFaces[i] for i in misses]
+        if self.batcher is not None:
+            futures = [self.batcher.submit(alignedFace) for alignedFace in faces]
+            results = [future.result() for future in futures]
+        else:
+            with self.neuralNetLock:
+                results = self.recognize_faces(faces)
+        seconds = (time.time() - start) / len(misses)
+        for i, persondict in zip(misses, results):
+            persondicts[i] = persondict
+            if location is not None and persondict is not None:
+                self.cache.put(location, keys[i], persondict, seconds)
+        return persondicts
+
     def recognize_face(self,img):
         rep1 = self.getRep(img) # Gets embedding representation of image
         if rep1 is None:
@@ -140,13 +315,9 @@ class FaceRecogniser(object):
         #rep = np.array(rep1).reshape(1, -1)   #take the image and  reshape the image array to a single line instead of 2 dimensionals
         start = time.time()
         logger.info("Submitting array for prediction.")
-        #predictions = self.clf.predict_proba(rep1).ravel() # Computes probabilities of possible outcomes for samples in classifier(clf).
-        # Computes probabilities of possible outcomes for samples in classifier(clf).
-        predictions = self.clf.predict_proba(rep1.cpu().detach().numpy()).ravel() 
-        #logger.info("We need to dig here to know why the probability are not right.")
-        maxI = np.argmax(predictions)
-        person1 = self.le.inverse_transform([maxI])[0] #TODO check if  return value is always list/array
-        confidence1 = int(math.ceil(predictions[maxI]*100))
+        names, confidences = self.classify(rep1.cpu().detach().numpy())
+        person1 = names[0]
+        confidence1 = confidences[0]
 
         logger.info("Recognition took {} seconds.".format(time.time() - start))
         logger.info("Recognized {} with {:.2f} confidence.".format(person1, confidence1))
@@ -156,40 +327,116 @@ class FaceRecogniser(object):
         persondict = {'name': person1, 'confidence': confidence1, 'rep':rep1}
         return persondict
 
+    def recognize_faces(self, alignedFaces):
+        """Batched recognize_face, embeds all faces with one forward
+        pass and classifies them with one classifier call. Returns a 
+        persondict per face, in order"""
+        start = time.time()
+        reps = self.getReps(alignedFaces)
+        names, confidences = self.classify(reps.cpu().detach().numpy())
+        persondicts = []
+        for i in range(len(alignedFaces)):
+            persondicts.append({'name': names[i], 'confidence': confidences[i], 'rep': reps[i:i+1]})
+        logger.info("Recognition of {} faces took {} seconds.".format(len(alignedFaces), time.time() - start))
+        return persondicts
+
+    def classify(self, reps):
+        """Predicts the identity of Nx128 embeddings with the gallery
+        or the classifier, returns a list of names and a list of 
+        confidences (0-100)"""
+        if self.useGallery:
+            return self.gallery.match(reps)
+        le, clf, predictor = self.classifier # Read once, a retrain may swap in a new classifier at any time
+        # Computes probabilities of possible outcomes for samples in classifier(clf).
+        if predictor is not None: # Compiled linear SVM, one matrix product for all faces
+            predictions = predictor.predict_proba(reps)
+        else:
+            predictions = clf.predict_proba(reps)
+        maxI = np.argmax(predictions, axis=1)
+        names = le.inverse_transform(maxI)
+        confidences = [int(math.ceil(predictions[i, maxI[i]]*100)) for i in range(len(maxI))]
+        return list(names), confidences
+
+    def enroll_face(self, name, alignedFace):
+        """Adds an aligned face to the gallery straight away, the
+        classifier still needs retraining to learn it"""
+        with self.neuralNetLock:
+            rep = self.getRep(alignedFace)
+        self.gallery.enroll(name, rep.cpu().detach().numpy())
+        self.gallery.save(galleryPath)
+        self.cache.clear()
+        logger.info("Enrolled a face of " + name + " in the gallery")
+
+    def input_batch(self, size):
+        """Returns a preallocated Nx3x96x96 input array, grown when 
+        a larger batch is needed. Callers must hold neuralNetLock"""
+        if self.inputBatch is None or self.inputBatch.shape[0] < size:
+            self.inputBatch = np.empty((max(size, EMBEDDING_BATCH_SIZE), 3, 96, 96), dtype=np.float32)
+        return self.inputBatch[:size]
+
+    def preprocess(self, alignedFace, out):
+        OpenFaceEngine.preprocess(alignedFace, out)
+
     def getRep(self, alignedFace):
         bgrImg = alignedFace
         if bgrImg is None:
             logger.error("unable to load image")
             return None
-        logger.info("Tweaking the face color ")
-        img = cv2.cvtColor(bgrImg, cv2.COLOR_BGR2RGB)
-        img = cv2.resize(img, (96, 96), interpolation=cv2.INTER_LINEAR)
-        img = np.transpose(img, (2, 0, 1))
-        img = img.astype(np.float32) / 255.0
-        start = time.time()
         logger.info("Getting embedding for the face")
-        
-        I_ = torch.from_numpy(img).unsqueeze(0)
+        return self.getReps([bgrImg]) # Gets embedding - 128 measurements
+
+    def getReps(self, alignedFaces):
+        """Embeds a list of aligned faces with a single forward pass,
+        returns an Nx128 tensor"""
+        batch = self.input_batch(len(alignedFaces))
+        for i, alignedFace in enumerate(alignedFaces):
+            self.preprocess(alignedFace, batch[i])
+        I_ = torch.from_numpy(batch)
         if args.cuda:
             I_ = I_.cuda()
-        rep = self.net.forward(I_) # Gets embedding - 128 measurements
-        return rep
+        with torch.no_grad():
+            return self.net.forward(I_)
     
-    def reloadClassifier(self):
-        with open("generated-embeddings/classifier.pkl", 'r') as f: # Reloads character stream from pickle file
-            (self.le, self.clf) = pickle.load(f) # Loads labels and classifier SVM or GMM
+    def reloadClassifier(self, path=classifierPath):
         logger.info("reloadClassifier called")
+        self.load_classifier(path)
+        self.reload_gallery()
         return True
 
-    def trainClassifier(self):
+    def reload_gallery(self, path=galleryPath):
+        """Reloads the gallery saved by another process' enroll_face"""
+        if os.path.isfile(path):
+            self.gallery.load(path)
+            self.cache.clear()
+
+    def load_classifier(self, path):
+        """Loads a (labels, classifier) pickle and swaps it in"""
+        with open(path, 'rb') as f: # le = labels, clf = classifier
+            le, clf = pickle.load(f, encoding='bytes') # Loads labels and classifier SVM or GMM
+        self.set_classifier(le, clf)
+        logger.info("Loaded classifier " + path)
+
+    def set_classifier(self, le, clf):
+        """Swaps in a classifier with a single assignment, so recognition
+        running in other threads uses either the old or the new classifier,
+        never a mix. A linear SVM is compiled into a LinearSVMPredictor,
+        which is only used if it matches clf.predict_proba"""
+        self.classifier = (le, clf, LinearSVMPredictor.LinearSVMPredictor.compile_verified(clf))
+        self.cache.clear()
+
+    def trainClassifier(self, progress=None):
         """Trainng the classifier begins by aligning any images in the
         training-images directory and putting them into the aligned images
         directory. Each of the aligned face images are passed through the
         neural net and the resultant embeddings along with their
         labels (names of the people) are used to train the classifier
-        which is saved to a pickle file as a character stream"""
+        which is saved to a pickle file as a character stream. progress
+        is called with (stage, done, total) as training proceeds, and
+        the path of the versioned classifier is returned"""
 
         logger.info("trainClassifier called")
+        if progress is None:
+            progress = lambda stage, done=0, total=0: None
 
         path = fileDir + "/aligned-images/cache.t7"
         try:
@@ -199,89 +446,134 @@ class FaceRecogniser(object):
             pass
 
         start = time.time()
-        aligndlib.alignMain("training-images/","aligned-images/","outerEyesAndNose",args.dlibFacePredictor,args.imgDim)
+        progress("aligning")
+        aligndlib.alignMain("training-images/","aligned-images/","outerEyesAndNose",args.dlibFacePredictor,args.imgDim,progress=progress)
         logger.info("Aligning images for training took {} seconds.".format(time.time() - start))
         done = False
         start = time.time()
 
-        done = self.generate_representation()
+        done = self.generate_representation(progress)
 
         if done is True:
             logger.info("Representation Generation (Classification Model) took {} seconds.".format(time.time() - start))
             start = time.time()
             # Train Model
-            self.train("generated-embeddings/","LinearSvm",-1)
+            progress("training")
+            fName = self.train("generated-embeddings/","LinearSvm",-1)
             logger.info("Training took {} seconds.".format(time.time() - start))
+            return fName
         else:
             logger.info("Generate representation did not return True")
+            return None
 
-    def generate_representation(self):
+    def generate_representation(self, progress=None):
+        """Generates an embedding for every aligned image and writes
+        them to the EmbeddingStore. The store records each embedding's
+        image path, mtime, size and content hash, so only new or changed
+        images are passed through the network, embeddings of deleted 
+        images are dropped and all other embeddings are reused"""
+        previous = EmbeddingStore.EmbeddingStore.load(storePath)
+        manifest = {}
+        byHash = {} # Finds renamed or copied images
+        if previous is not None:
+            for row, entry in enumerate(previous.metadata.get('files', [])):
+                manifest[entry['path']] = entry
+                byHash[entry['hash']] = row
+
+        files = []
+        names = []
         labels = []
         reps = []
-        with open(genEmbedDir + os.sep + 'labels.csv', 'w') as labels_file:
-            label_writer = csv.writer(labels_file)
-            idx = 0
-            last_cls = ""
-            for subdir, dirs, files in os.walk(alignedImgDir):
-                for filename in files:
-                    filepath = subdir + os.sep + filename
-                    print(filename)
-                    if filename.endswith(".jpg") or filename.endswith(".png"):
+        total = sum(len(filenames) for subdir, dirs, filenames in os.walk(alignedImgDir))
+        count = 0
+        embedded = 0
+        for subdir, dirs, filenames in sorted(os.walk(alignedImgDir)):
+            for filename in sorted(filenames):
+                count += 1
+                if progress is not None:
+                    progress("embedding", count, total)
+                filepath = subdir + os.sep + filename
+                if filename.endswith(".jpg") or filename.endswith(".png"):
+                    cls = subdir.split(os.sep)[-1]
+                    relpath = 'aligned-images' + os.sep + cls + os.sep + filename
+                    stat = os.stat(filepath)
+                    entry = manifest.get(relpath)
+                    if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                        fileHash = entry['hash'] # Unchanged, no need to read the file
+                    else:
+                        with open(filepath, 'rb') as f:
+                            fileHash = hashlib.sha1(f.read()).hexdigest()
+
+                    if fileHash in byHash:
+                        rep = previous.embeddings[byHash[fileHash]]
+                    else:
                         print(filepath)
-                        cls = subdir.split(os.sep)[-1]
-                        if cls != last_cls:
-                            idx += 1
-                            last_cls = cls
-                        #alignedImage = openface.data.Image(cls, filename, filepath)
                         alignedImage = cv2.imread(filepath)
-                        #print(alignedImage)
-                        rep = self.getRep(alignedImage)
-                        #print(rep)
-                        label_row = [str(idx), 'aligned-images' + os.sep + cls + os.sep + filename]
-                        label_writer.writerow(label_row)
-                        reps.append(rep.cpu().detach().numpy())
-            
-        if reps:
-            np.save(genEmbedDir + os.sep + 'reps.npy', np.row_stack(reps))
+                        if alignedImage is None:
+                            logger.info("Unable to read " + filepath)
+                            continue
+                        with self.neuralNetLock:
+                            rep = self.getRep(alignedImage).cpu().detach().numpy()[0]
+                        embedded += 1
+
+                    if not names or names[-1] != cls:
+                        names.append(cls)
+                    labels.append(len(names) - 1)
+                    files.append({'path': relpath, 'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': fileHash})
+                    reps.append(rep)
+
+        logger.info("Embedded {} new or changed images, reused {} embeddings".format(embedded, len(reps) - embedded))
+        embeddings = np.vstack(reps) if reps else np.zeros((0, FaceGallery.EMBEDDING_DIM), dtype=np.float32)
+        EmbeddingStore.EmbeddingStore.write(storePath, embeddings, labels, names, {'files': files})
         return True
 
+    def migrate_legacy_embeddings(self):
+        """Converts the reps.npy and labels.csv of installs that predate
+        the EmbeddingStore into a store, so they keep recognising people
+        without retraining. Embeddings of aligned images that no longer
+        exist are dropped. Returns the store, None if there is nothing
+        to migrate"""
+        if not os.path.isfile(legacyRepsPath) or not os.path.isfile(legacyLabelsPath):
+            return None
+        embeddings = np.load(legacyRepsPath).reshape(-1, FaceGallery.EMBEDDING_DIM)
+        with open(legacyLabelsPath) as labelsFile:
+            rows = [row for row in csv.reader(labelsFile) if row]
+        if len(rows) != len(embeddings):
+            logger.warning("{} has {} rows for {} embeddings, retrain the classifier".format(legacyLabelsPath, len(rows), len(embeddings)))
+            return None
+
+        files = []
+        names = []
+        labels = []
+        kept = []
+        for row, (_, relpath) in enumerate(rows):
+            filepath = os.path.join(fileDir, relpath)
+            if not os.path.isfile(filepath):
+                continue
+            cls = relpath.split(os.sep)[-2]
+            stat = os.stat(filepath)
+            with open(filepath, 'rb') as f:
+                fileHash = hashlib.sha1(f.read()).hexdigest()
+            if cls not in names:
+                names.append(cls)
+            labels.append(names.index(cls))
+            files.append({'path': relpath, 'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': fileHash})
+            kept.append(row)
+
+        EmbeddingStore.EmbeddingStore.write(storePath, embeddings[kept], labels, names, {'files': files})
+        logger.info("Migrated {} of {} legacy embeddings to {}".format(len(kept), len(rows), storePath))
+        return EmbeddingStore.EmbeddingStore.load(storePath)
+
     def train(self, workDir, classifier, ldaDim):
-        fname = "{}labels.csv".format(workDir) #labels of faces
-        logger.info("Loading labels " + fname + " csv size: " +  str(os.path.getsize("{}reps.csv".format(workDir))))
-        print("Loading labels " + fname + " csv size: " +  str(os.path.getsize("{}reps.csv".format(workDir))))
-        if os.path.getsize(fname) > 0:
-            logger.info(fname + " file is not empty")
-            print(fname + " file is not empty")
-            #labels = pd.read_csv(fname, header=None).as_matrix()[:, 1]
-            pd_csv = pd.read_csv(fname, header=None).to_numpy()
-            print(pd_csv)
-            #labels = pd_csv.values[:, 1]
-            labels = pd_csv[:, 1]
-            logger.info(labels)
-        else:
-            logger.info(fname + " file is empty")
-            print(fname + " file is empty")
-            labels = "1:aligned-images/dummy/1.png"  #creating a dummy string to start the process
-        #print("1>labels: {}".format(labels))
-        logger.debug(map(os.path.dirname, labels))
-        logger.debug(map(os.path.split,map(os.path.dirname, labels)))
-        logger.debug(map(itemgetter(1),map(os.path.split,map(os.path.dirname, labels))))
-       
-        labels = list(map(itemgetter(1),map(os.path.split,map(os.path.dirname, labels))))
-        #print("2>labels: {}".format(labels))
-
-        fname = "{}reps.csv".format(workDir) # Representations of faces
-        fnametest = format(workDir) + "reps.csv"
-        logger.info("Loading embedding " + fname + " csv size: " + str(os.path.getsize(fname)))
-        if os.path.getsize(fname) > 0:
-            logger.info(fname + " file is not empty")
-            embeddings = np.load('{}reps.npy'.format(workDir), allow_pickle=True) 
-        else:
-            logger.info(fname + " file is empty")
-            embeddings = np.zeros((2,150)) #creating an empty array since csv is empty
-        
-        #print("embeddings", embeddings)
-        
+        fname = "{}embeddings.bin".format(workDir) # Embeddings and labels of faces
+        store = EmbeddingStore.EmbeddingStore.load(fname)
+        if store is None or len(store) == 0:
+            logger.info(fname + " has no embeddings, nothing to train")
+            return None
+        logger.info("Loaded {} embeddings of {} people from {}".format(len(store), len(store.names), fname))
+        labels = store.label_names()
+        embeddings = np.asarray(store.embeddings)
+
         print("labels {}".format(labels))
         # LabelEncoder is a utility class to help normalize labels such that they contain only values between 0 and n_classes-1
         self.le = LabelEncoder().fit(labels) 
@@ -337,17 +629,56 @@ class FaceRecogniser(object):
 
         self.clf.fit(embeddings, labelsNum) #link embeddings to labels
 
-        fName = "{}/classifier.pkl".format(workDir)
+        if embeddings.shape[1] == self.gallery.dim: # The gallery is rebuilt from the same embeddings
+            self.gallery.build(embeddings, labels)
+            self.gallery.save(galleryPath)
+
+        # Each training run writes a new version, classifier.pkl is then replaced atomically
+        version = datetime.now().strftime("%Y%m%d%H%M%S")
+        fName = "{}/classifier-v{}.pkl".format(workDir, version)
         logger.info("Saving classifier to '{}'".format(fName))
         print("Saving classifier to '{}'".format(fName))
         with open(fName, 'wb') as f:
             pickle.dump((self.le,  self.clf), f) # Creates character stream and writes to file to use for recognition  
+        with open("{}/classifier.pkl.tmp".format(workDir), 'wb') as f:
+            pickle.dump((self.le,  self.clf), f)
+        os.replace("{}/classifier.pkl.tmp".format(workDir), "{}/classifier.pkl".format(workDir))
+        self.prune_classifiers(workDir)
+        self.set_classifier(self.le, self.clf)
         print("Training finished!")
+        return fName
             
+    def prune_classifiers(self, workDir, keep=CLASSIFIER_VERSIONS_KEPT):
+        """Deletes all but the newest keep versioned classifiers, their
+        timestamps sort in the order they were written"""
+        versions = sorted(glob.glob(os.path.join(workDir, "classifier-v*.pkl")))
+        for path in versions[:-keep]:
+            try:
+                os.remove(path)
+                logger.info("Removed old classifier " + path)
+            except OSError as e:
+                logger.info("Could not remove old classifier " + path + ": " + str(e))
+
     def getSquaredl2Distance(self,rep1,rep2):
         """Returns number between 0-4, Openface calculated the mean between
         similar faces is 0.99 i.e. returns less than 0.99 if reps both belong
         to the same person"""
         d = torch.norm(rep1 - rep2, 2, 1).item()
         print("distance", d)        
-        return d
\ No newline at end of file
+        return d
+
+if __name__ == '__main__':
+    # Used by TrainingJob to retrain the classifier in a separate process.
+    # Progress is reported on stdout as TrainingJob.STATUS_PREFIX followed by json
+    import TrainingJob
+
+    def report(stage, done=0, total=0, classifier=None):
+        status = {'stage': stage, 'done': done, 'total': total, 'classifier': classifier}
+        sys.stdout.write(TrainingJob.STATUS_PREFIX + json.dumps(status) + "\n")
+        sys.stdout.flush()
+
+    os.chdir(fileDir)
+    fName = FaceRecogniser(batchEmbeddings=False).trainClassifier(progress=report)
+    if fName is None:
+        sys.exit(1)
+    report("finished", classifier=os.path.abspath(fName))
@@ -31,6 +31,7 @@ import math
 import threading
 import logging
 import time
+import ModelRegistry
 start = time.time()
 import numpy as np
 
@@ -58,11 +59,16 @@ if cuda and dlib.cuda.get_num_devices()>0:
     print("ImageUtils DLIB using CUDA")
     dlib.DLIB_USE_CUDA = True
 
+MERGE_PADDING = 16 # Pixels added around motion regions before overlapping regions are merged
+MAX_DETECTION_CROPS = 4 # Most regions face detection is run on per frame
+FULL_FRAME_AREA_RATIO = 0.6 # Detect faces in the whole frame once the regions cover this fraction of it
+
 cascade_lock = threading.Lock()
-facecascade = cv2.CascadeClassifier("models/haarcascade_frontalface_alt2.xml")
-uppercascade = cv2.CascadeClassifier("models/haarcascade_upperbody.xml")
-eyecascade = cv2.CascadeClassifier("models/haarcascade_eye.xml")
-detector = dlib.get_frontal_face_detector()
+# Models are loaded the first time they are used and shared with FaceDetector
+ModelRegistry.models.register('frontalface_cascade', lambda: cv2.CascadeClassifier("models/haarcascade_frontalface_alt2.xml"))
+ModelRegistry.models.register('upperbody_cascade', lambda: cv2.CascadeClassifier("models/haarcascade_upperbody.xml"))
+ModelRegistry.models.register('eye_cascade', lambda: cv2.CascadeClassifier("models/haarcascade_eye.xml"))
+ModelRegistry.models.register('dlib_hog', dlib.get_frontal_face_detector)
     
 def resize(frame):
     r = 640.0 / frame.shape[1]
@@ -80,8 +86,8 @@ def resize_mjpeg(frame):
 
 def crop(image, box, dlibRect = False):
     #if dlibRect == False or isinstance(box, tuple):
-    if isinstance(box, tuple):
-        x, y, w, h = box
+    if isinstance(box, (tuple, list, np.ndarray)):
+        x, y, w, h = (int(v) for v in box)
         return image[y: y + h, x: x + w] 
 
     return image[box.top():box.bottom(), box.left():box.right()]
@@ -91,6 +97,56 @@ def is_inside(o, i):
     ix, iy, iw, ih = i
     return ox > ix and oy > iy and ox + ow < ix + iw and oy + oh < iy + ih
 
+def _union(a, b):
+    return [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+
+def _area(box):
+    return (box[2] - box[0]) * (box[3] - box[1])
+
+def merge_rects(rects, width, height, padding=MERGE_PADDING, maxRects=MAX_DETECTION_CROPS):
+    """Pads (x, y, w, h) rectangles, unions those that overlap or touch
+    and then merges the pair that adds the least area until at most 
+    maxRects are left. Rectangles are clipped to the frame"""
+    boxes = [[max(x - padding, 0), max(y - padding, 0), min(x + w + padding, width), min(y + h + padding, height)]
+             for x, y, w, h in rects]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]:
+                    boxes[i] = _union(a, b)
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    while len(boxes) > maxRects:
+        pairs = [(i, j) for i in range(len(boxes)) for j in range(i + 1, len(boxes))]
+        i, j = min(pairs, key=lambda p: _area(_union(boxes[p[0]], boxes[p[1]])) - _area(boxes[p[0]]) - _area(boxes[p[1]]))
+        boxes[i] = _union(boxes[i], boxes[j])
+        del boxes[j]
+    return [(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in boxes]
+
+def detection_regions(rects, width, height, allowFullFrame=True):
+    """Returns the regions of a frame face detection should run on for
+    the given motion rectangles. Neighbouring rectangles are merged so
+    one person is detected once, and if the merged regions cover most 
+    of the frame a single detection on the whole frame is cheaper"""
+    regions = merge_rects(rects, width, height)
+    if allowFullFrame and sum(w * h for x, y, w, h in regions) >= FULL_FRAME_AREA_RATIO * width * height:
+        return [(0, 0, width, height)]
+    return regions
+
+def region_to_frame(region, box, flipped=False):
+    """Maps a dlib rectangle found in the crop of an (x, y, w, h) frame
+    region to (x, y, w, h) frame coordinates. flipped is True if the
+    crop was mirrored horizontally before detection"""
+    x, y, w, h = (int(v) for v in region)
+    left = w - 1 - box.right() if flipped else box.left() # dlib rectangles include their right column
+    return (x + left, y + box.top(), box.width(), box.height())
+
 def draw_boxes(image, rects, dlibrects):
     if dlibrects:
         image = draw_rects_dlib(image, rects)
@@ -104,6 +160,7 @@ def draw_rects_cv(img, rects, color=(0, 40, 255)):
     output = img.copy()
     #count = 1
     for x, y, w, h in rects:
+        x, y, w, h = int(x), int(y), int(w), int(h) # Detections are numpy arrays
         cv2.rectangle(overlay, (x, y), (x+w, y+h), color, 2)
         cv2.addWeighted(overlay, 0.5, output, 0.5, 0, output)
     return output
@@ -142,7 +199,8 @@ def draw_rects_dlib(img, rects):
     return output
 
 def detect_upper_cascade(img):
-    rects = uppercascade.detectMultiScale(img, scaleFactor=1.2, minNeighbors=4, minSize=(30, 30), flags = cv2.CASCADE_SCALE_IMAGE)
+    with ModelRegistry.models.using('upperbody_cascade') as uppercascade:
+        rects = uppercascade.detectMultiScale(img, scaleFactor=1.2, minNeighbors=4, minSize=(30, 30), flags = cv2.CASCADE_SCALE_IMAGE)
     return rects
 
 def detect_people_hog(image):
@@ -170,7 +228,8 @@ def pre_processing(image):
 
 def detect_people_cascade(image):
     image = rgb_pre_processing(image)
-    rects = detect_cascade(image, uppercascade)
+    with ModelRegistry.models.using('upperbody_cascade') as uppercascade:
+        rects = detect_cascade(image, uppercascade)
     image = draw_rects_cv(image, rects,color=(0, 255, 0))  
     return image
 
@@ -182,7 +241,8 @@ def detectopencv_face(image):
 
 def detectlight_face(image):
     image = pre_processing(image)
-    rectscv = detect_cascade(image,facecascade)
+    with ModelRegistry.models.using('frontalface_cascade') as facecascade:
+        rectscv = detect_cascade(image, facecascade)
     processedimg = draw_rects_cv(image, rectscv)
     rectsdlib = detectdlibgrey_face(image)
     processedimg = draw_rects_dlib(processedimg, rectsdlib)
@@ -191,7 +251,8 @@ def detectlight_face(image):
 
 
 def detectdlibgrey_face(grey):
-    bbs = detector(grey,1)
+    with ModelRegistry.models.using('dlib_hog') as detector:
+        bbs = detector(grey,1)
     return bbs
 
 def detectdlib_face(img,height,width):
@@ -0,0 +1,124 @@
+# LinearSVMPredictor.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+MIN_PROBABILITY = 1e-7 # libsvm clips pairwise probabilities to [MIN_PROBABILITY, 1 - MIN_PROBABILITY]
+VERIFY_TOLERANCE = 1e-6 # Largest probability difference to sklearn accepted when a classifier is compiled
+VERIFY_SAMPLES = 256
+
+class LinearSVMPredictor(object):
+    """The LinearSVMPredictor computes the predict_proba of a trained
+    linear SVC(probability=True) with plain numpy. The weights of the
+    one-vs-one classifiers are a single matrix, so the decision values
+    of a batch of faces are one matrix product. They are turned into
+    pairwise probabilities with the classifier's Platt scaling and
+    coupled into class probabilities with libsvm's iterative method,
+    run for all faces at once. No sklearn validation runs per call"""
+
+    def __init__(self, weights, bias, probA, probB, nClasses):
+        self.weights = weights # features x pairs, in libsvm's decision sign
+        self.bias = bias
+        self.probA = probA
+        self.probB = probB
+        self.nClasses = nClasses
+        self.pairs = [(i, j) for i in range(nClasses) for j in range(i + 1, nClasses)] # libsvm's pair order
+
+    @staticmethod
+    def compile(clf):
+        """Returns the predictor of a fitted linear SVC with probability
+        estimates, None for any other classifier"""
+        if type(clf).__name__ != 'SVC' or clf.kernel != 'linear' or clf.probability is not True: # Newer sklearn defaults probability to a deprecation marker
+            return None
+        probA = getattr(clf, 'probA_', None)
+        probB = getattr(clf, 'probB_', None)
+        if probA is None or probB is None: # Private in some sklearn versions
+            probA, probB = clf._probA, clf._probB
+        weights = np.array(clf.coef_, dtype=np.float64).T
+        bias = np.array(clf.intercept_, dtype=np.float64)
+        nClasses = len(clf.classes_)
+        if nClasses == 2: # sklearn negates the binary decision function, libsvm's probabilities use the original
+            weights, bias = -weights, -bias
+        return LinearSVMPredictor(weights, bias, np.asarray(probA, dtype=np.float64),
+                                  np.asarray(probB, dtype=np.float64), nClasses)
+
+    @staticmethod
+    def compile_verified(clf, samples=None):
+        """Compiles clf and checks its probabilities against
+        clf.predict_proba on samples, by default the classifier's
+        support vectors. Returns None if it cannot be compiled or
+        does not match"""
+        try:
+            predictor = LinearSVMPredictor.compile(clf)
+        except Exception as e:
+            logger.warning("Could not compile the classifier: " + str(e))
+            return None
+        if predictor is None:
+            return None
+        if samples is None:
+            samples = clf.support_vectors_[:VERIFY_SAMPLES]
+        difference = np.abs(predictor.predict_proba(samples) - clf.predict_proba(samples)).max()
+        if not difference <= VERIFY_TOLERANCE:
+            logger.warning("Compiled classifier differs from predict_proba by {:.2e}, using sklearn".format(difference))
+            return None
+        logger.info("Compiled the linear SVM, largest difference to predict_proba {:.2e}".format(difference))
+        return predictor
+
+    def decision_function(self, X):
+        """Returns the Nxpairs one-vs-one decision values"""
+        return np.dot(np.asarray(X, dtype=np.float64).reshape(-1, self.weights.shape[0]), self.weights) + self.bias
+
+    def predict_proba(self, X):
+        """Returns the Nxclasses probabilities of X"""
+        fApB = self.decision_function(X) * self.probA + self.probB
+        e = np.exp(-np.abs(fApB)) # 1 / (1 + exp(fApB)) without overflow, as libsvm's sigmoid_predict
+        pairwise = np.clip(np.where(fApB >= 0, e / (1.0 + e), 1.0 / (1.0 + e)), MIN_PROBABILITY, 1 - MIN_PROBABILITY)
+
+        r = np.zeros((len(pairwise), self.nClasses, self.nClasses)) # r[:, i, j], probability of i rather than j
+        for k, (i, j) in enumerate(self.pairs):
+            r[:, i, j] = pairwise[:, k]
+            r[:, j, i] = 1 - pairwise[:, k]
+        return self.couple(r)
+
+    def couple(self, r):
+        """libsvm's multiclass_probability, the method of Wu, Lin and
+        Weng, for a batch of pairwise probability matrices. It couples
+        two classes too, as the libsvm bundled with sklearn does. Faces
+        stop iterating when they converge, as in libsvm"""
+        n, k = r.shape[0], self.nClasses
+        Q = -np.transpose(r, (0, 2, 1)) * r # Q[t, j] = -r[j, t] * r[t, j]
+        Q[:, np.arange(k), np.arange(k)] = np.sum(r * r, axis=1) # Q[t, t] = sum of r[j, t]^2, r[t, t] is 0
+        p = np.full((n, k), 1.0 / k)
+        active = np.arange(n)
+        eps = 0.005 / k
+        for _ in range(max(100, k)):
+            Qa, pa = Q[active], p[active]
+            Qp = np.einsum('ntj,nj->nt', Qa, pa)
+            pQp = np.sum(pa * Qp, axis=1)
+            converged = np.abs(Qp - pQp[:, None]).max(axis=1) < eps
+            active, Qa, pa, Qp, pQp = active[~converged], Qa[~converged], pa[~converged], Qp[~converged], pQp[~converged]
+            if len(active) == 0:
+                break
+            for t in range(k):
+                Qtt = Qa[:, t, t]
+                diff = (-Qp[:, t] + pQp) / Qtt
+                pa[:, t] += diff
+                pQp = (pQp + diff * (diff * Qtt + 2 * Qp[:, t])) / (1 + diff) / (1 + diff)
+                Qp = (Qp + diff[:, None] * Qa[:, t, :]) / (1 + diff)[:, None]
+                pa /= (1 + diff)[:, None]
+            p[active] = pa
+        return p
@@ -0,0 +1,75 @@
+# ModelRegistry.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from contextlib import contextmanager
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ModelRegistry(object):
+    """The ModelRegistry loads every detection model once per process,
+    the first time it is used, instead of once per camera, so memory
+    stays flat as cameras are added. Models are registered by name
+    with a loader function and shared by every camera thread. A model
+    is run through using(), which holds its lock so inference on it is
+    serialised. Forked worker processes load the models they use
+    themselves"""
+
+    def __init__(self):
+        self.lock = threading.Lock() # Guards registration and loading
+        self.loaders = {} # Name -> loader
+        self.models = {} # Name -> loaded model
+        self.modelLocks = {} # Name -> lock serialising inference of a model
+
+    def register(self, name, loader):
+        """Registers a model's loader, a name is only registered once"""
+        with self.lock:
+            if name not in self.loaders:
+                self.loaders[name] = loader
+                self.modelLocks[name] = threading.Lock()
+
+    def _load(self, name, loader):
+        start = time.time()
+        model = loader()
+        logger.info("Loaded model {} in {:.2f}s".format(name, time.time() - start))
+        return model
+
+    def get(self, name):
+        """Returns a model, loading it if it has not been used yet.
+        Models must only be run through using()"""
+        model = self.models.get(name)
+        if model is None:
+            with self.lock:
+                model = self.models.get(name)
+                if model is None:
+                    model = self._load(name, self.loaders[name])
+                    self.models[name] = model
+        return model
+
+    @contextmanager
+    def using(self, name):
+        """Holds a model's inference lock while it is used i.e
+        with models.using('ssd') as net: ..."""
+        model = self.get(name)
+        with self.modelLocks[name]:
+            yield model
+
+    def loaded(self):
+        """Names of the models loaded in this process"""
+        with self.lock:
+            return list(self.models)
+
+models = ModelRegistry() # Process wide registry used by FaceDetector and ImageUtils
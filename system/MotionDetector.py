@@ -19,118 +19,283 @@
 import cv2
 import numpy as np
 import logging
+import hashlib
+import os
 
 logger = logging.getLogger(__name__)
-cv2_version = cv2.__version__
+
+fileDir = os.path.dirname(os.path.realpath(__file__))
+clutterMapDir = os.path.join(fileDir, 'motion-maps')
+
+BACKGROUND_WARMUP = 5 # Frames averaged with equal weight to build the initial background model
+BACKGROUND_LEARNING_RATE = 0.02 # Rate at which the background absorbs gradual changes i.e lighting drift
+BACKGROUND_FAST_LEARNING_RATE = 0.25 # Used while most of the frame changes at once i.e lights switched on
+BACKGROUND_FOREGROUND_LEARNING_RATE = 0.005 # Used under the foreground, objects left in the scene are absorbed in a few hundred frames
+DEBUG_DUMP_INTERVAL = 0 # Write the motion mask to motion.jpg every n frames, 0 disables the dumps
+ANALYSIS_WIDTH = 320 # Width frames are downsampled to before motion analysis, 0 analyses frames at full size
+MIN_AREA = 2000 # Smallest foreground blob, in pixels of the frame passed to detect_movement
+MAX_AREA = 90000 # Largest foreground blob that may be a person
+RESYNC_AREA = 100000 # Blobs this big mean the scene has changed as a whole
+CLUTTER_LEARNING_RATE = 0.002 # Rate of each pixel's running motion frequency, remembers roughly the last 500 frames
+CLUTTER_FREQUENCY = 0.5 # Pixels in the foreground more often than this are clutter, unless faces were found there
+CLUTTER_MIN_FRAMES = 1500 # Frames observed before clutter is suppressed
+CLUTTER_UPDATE_INTERVAL = 25 # Frames between rebuilds of the clutter mask
+CLUTTER_SAVE_INTERVAL = 3000 # Frames between saves of the motion frequency map
+FACE_MEMORY_FRAMES = 4500 # Frames a face's box stays protected from clutter suppression after it was found
+
+def clutter_map_path(url):
+    """Returns the file the motion frequency map of a camera is persisted in"""
+    return os.path.join(clutterMapDir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.npz')
+
+def _odd(size):
+    """Rounds a filter size to the nearest odd size of at least 3"""
+    return max(3, int(round(size)) // 2 * 2 + 1)
 
 class MotionDetector(object):
     """The MotionDetector Object recieves frames captured from 
-    an IPCamera object and generates a background model used 
-    as a reference frame. This background model is constructed 
-    using filtering and frame averaging. Once the model has been
-    created, consecutive frames are compared to the reference frame
-    and regions of interest are located"""
+    an IPCamera object and maintains a background model used 
+    as a reference frame. The background model is an exponential
+    running average of filtered frames that is updated every frame,
+    so gradual lighting changes are absorbed without resetting the
+    model. Under detected foreground it learns much more slowly, so
+    people passing through are not absorbed but an object left in the
+    scene stops being reported as motion after a while. Consecutive
+    frames are compared to the reference frame and regions of 
+    interest are located. Frames are downsampled to analysisWidth 
+    before they are analysed, the filter sizes and area thresholds are
+    scaled to match and the regions are mapped back to the frame's 
+    coordinates. Each detector owns preallocated working buffers that
+    every filtering step writes into, so processing a frame does not
+    allocate any images. A running per pixel motion frequency is kept
+    to learn chronically active regions such as trees, flags and TVs.
+    Regions that are in motion most of the time and where no faces 
+    have been reported recently are suppressed before regions are extracted.
+    The map is saved to clutterMapPath so it survives restarts. Motion
+    outside a camera's zones (see ZoneMask) is ignored"""
 
-    def __init__(self):
+    def __init__(self, analysisWidth=ANALYSIS_WIDTH, debugDumpInterval=DEBUG_DUMP_INTERVAL, clutterMapPath=None):
         self.history = 0 # Keeps track of the number of frames that have been processed
-        self.currentFrame = None  
-        self.previousFrame = None
-        self.meanFrame = None # Frame averaging
         self.motion = False
         self.person = False
         self.peopleRects = [] # Holds all regions of interest that may contain a person
+        self.analysisWidth = analysisWidth
+        self.debugDumpInterval = debugDumpInterval
+        self.clutterMapPath = clutterMapPath
+        self.suppressClutter = True
+        self.zoneMask = None # ZoneMask of the camera, None processes the whole frame
+        self.roiMask = None # Zone mask at the analysis size, 255 where motion is detected
+        self.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+        self.frameShape = None # Shape of the frames the working buffers were allocated for
+        self.background = None # float32 running average of the filtered frames
+        self.meanFrame = None # 8 bit reference frame derived from the background model
+
+    def allocate_buffers(self, height, width):
+        """Allocates the working buffers for frames of the given size,
+        only called again if the camera's resolution changes"""
+        self.frameShape = (height, width)
+        self.scale = 1.0 # Analysis size / frame size
+        if self.analysisWidth and self.analysisWidth < width:
+            self.scale = self.analysisWidth / float(width)
+        self.shape = (max(1, int(round(height * self.scale))), max(1, int(round(width * self.scale))))
+        self.medianSize = _odd(9 * self.scale)
+        self.gaussianSize = (_odd(11 * self.scale),) * 2
+        kernelSize = _odd(5 * self.scale)
+        self.kernel = np.ones((kernelSize, kernelSize), np.uint8)
+        areaScale = self.scale * self.scale
+        self.minArea, self.maxArea, self.resyncArea = MIN_AREA * areaScale, MAX_AREA * areaScale, RESYNC_AREA * areaScale
+
+        self.resized = np.empty(self.shape + (3,), dtype=np.uint8) # Downsampled colour frame
+        self.gray = np.empty(self.shape, dtype=np.uint8) # Grayscale analysis frame
+        self.filtered = np.empty(self.shape, dtype=np.uint8) # Filtered frame compared against the background
+        self.scratch = np.empty(self.shape, dtype=np.uint8) # Intermediate result between filters
+        self.background = np.zeros(self.shape, dtype=np.float32)
+        self.meanFrame = np.empty(self.shape, dtype=np.uint8)
+        self.frameDelta = np.empty(self.shape, dtype=np.uint8)
+        self.thresh = np.empty(self.shape, dtype=np.uint8) # Foreground mask
+        self.labels = np.empty(self.shape, dtype=np.int32) # Foreground blob of every pixel
+        self.backgroundMask = np.empty(self.shape, dtype=np.uint8) # Pixels the background model learns from
+        self.frequency = np.zeros(self.shape, dtype=np.float32) # Running fraction of frames each pixel is foreground, 0-255
+        self.faceSeen = np.zeros(self.shape, dtype=np.float32) # Frames each pixel stays protected after a face was found there
+        self.clutterMask = np.full(self.shape, 255, dtype=np.uint8) # 0 where motion is suppressed
+        self.clutterFrames = 0 # Frames the motion frequency has been learnt from
+        self.roiMask = self.zoneMask.mask(*self.shape) if self.zoneMask else None
+        self.history = 0
+        if self.clutterMapPath:
+            self.load_clutter_map()
 
     def reset_background_model(self):
         self.history = 0
 
+    def learning_rate(self, resync):
+        """The background learns quickly while warming up or when the 
+        whole scene has changed, and slowly otherwise"""
+        if self.history < BACKGROUND_WARMUP:
+            return 1.0 / (self.history + 1) # Equal weight average of the warm up frames
+        if resync:
+            return BACKGROUND_FAST_LEARNING_RATE
+        return BACKGROUND_LEARNING_RATE
+
+    def set_zones(self, zoneMask):
+        """Restricts motion detection to the zones of a ZoneMask"""
+        self.zoneMask = zoneMask
+        if self.frameShape is not None:
+            self.roiMask = zoneMask.mask(*self.shape) if zoneMask else None
+
+    def update_clutter(self):
+        """Learns the motion frequency from the current foreground mask,
+        rebuilds the clutter mask and saves the map periodically"""
+        cv2.accumulateWeighted(self.thresh, self.frequency, CLUTTER_LEARNING_RATE)
+        self.clutterFrames += 1
+        if self.clutterFrames % CLUTTER_UPDATE_INTERVAL == 0:
+            # Face protection wears off, so one face does not disable clutter suppression for good
+            np.subtract(self.faceSeen, CLUTTER_UPDATE_INTERVAL, out=self.faceSeen)
+            np.maximum(self.faceSeen, 0, out=self.faceSeen)
+            self.update_clutter_mask()
+        if self.clutterMapPath and self.clutterFrames % CLUTTER_SAVE_INTERVAL == 0:
+            self.save_clutter_map()
+
+    def update_clutter_mask(self):
+        self.clutterMask.fill(255)
+        if self.clutterFrames < CLUTTER_MIN_FRAMES:
+            return
+        clutter = (self.frequency > CLUTTER_FREQUENCY * 255) & (self.faceSeen <= 0)
+        self.clutterMask[clutter] = 0
+
+    def report_faces(self, rects):
+        """Marks the (x, y, w, h) frame boxes of faces that have been
+        found, they are not suppressed as clutter for the next
+        FACE_MEMORY_FRAMES frames"""
+        if self.frameShape is None:
+            return
+        for (x, y, w, h) in rects:
+            x0, y0 = int(x * self.scale), int(y * self.scale)
+            x1, y1 = int(np.ceil((x + w) * self.scale)), int(np.ceil((y + h) * self.scale))
+            self.faceSeen[max(y0, 0):y1, max(x0, 0):x1] = FACE_MEMORY_FRAMES
+            self.clutterMask[max(y0, 0):y1, max(x0, 0):x1] = 255
+
+    def save_clutter_map(self):
+        if not os.path.isdir(clutterMapDir):
+            os.makedirs(clutterMapDir)
+        tmpPath = self.clutterMapPath + ".tmp.npz"
+        np.savez(tmpPath, frequency=self.frequency, faceSeen=self.faceSeen, frames=self.clutterFrames)
+        os.replace(tmpPath, self.clutterMapPath)
+        logger.debug("Saved motion frequency map to " + self.clutterMapPath)
+
+    def load_clutter_map(self):
+        """Restores a saved motion frequency map if it was learnt at the current analysis size"""
+        if not os.path.isfile(self.clutterMapPath):
+            return
+        try:
+            data = np.load(self.clutterMapPath)
+            if data['frequency'].shape != self.shape:
+                logger.info("Ignoring motion frequency map learnt at a different resolution " + self.clutterMapPath)
+                return
+            self.frequency[:] = data['frequency']
+            self.faceSeen[:] = data['faceSeen'] # Maps saved before faces wore off hold booleans, which expire at once
+            self.clutterFrames = int(data['frames'])
+        except Exception as e:
+            logger.warning("Could not load motion frequency map " + self.clutterMapPath + ": " + str(e))
+            return
+        self.update_clutter_mask()
+        logger.info("Loaded motion frequency map learnt over {} frames from {}".format(self.clutterFrames, self.clutterMapPath))
+
+    def filter_frame(self, frame, grayFrame):
+        """Downsamples the frame, converts it to grayscale, filters 
+        and blurs it into self.filtered"""
+        size = (self.shape[1], self.shape[0])
+        if grayFrame:
+            gray = frame if self.scale == 1.0 else cv2.resize(frame, size, dst=self.gray, interpolation=cv2.INTER_AREA)
+        else:
+            if self.scale != 1.0:
+                frame = cv2.resize(frame, size, dst=self.resized, interpolation=cv2.INTER_AREA)
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        self.clahe.apply(gray, dst=self.filtered)
+        cv2.medianBlur(self.filtered, self.medianSize, dst=self.scratch)  # Filters out noise
+        cv2.GaussianBlur(self.scratch, self.gaussianSize, 0, dst=self.filtered)
+        return self.filtered
+
+    def to_frame(self, rects):
+        """Maps Nx4 (x, y, w, h) rectangles from analysis to frame 
+        coordinates, returns a list of tuples"""
+        if self.scale == 1.0:
+            return [tuple(rect) for rect in rects.tolist()]
+        frameHeight, frameWidth = self.frameShape
+        mapped = np.empty(rects.shape, dtype=np.int64)
+        mapped[:, :2] = rects[:, :2] / self.scale
+        mapped[:, 2:] = np.ceil(rects[:, 2:] / self.scale)
+        np.minimum(mapped[:, 2], frameWidth - mapped[:, 0], out=mapped[:, 2])
+        np.minimum(mapped[:, 3], frameHeight - mapped[:, 1], out=mapped[:, 3])
+        return [tuple(rect) for rect in mapped.tolist()]
+
     def detect_movement(self,frame, get_rects, grayFrame=False):
             # Calculate mean standard deviation then determine if motion has actually accurred
-            if grayFrame:
-                height, width = frame.shape
-                gray = frame
-            else:
-                height, width, channels = frame.shape
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            if self.frameShape != frame.shape[:2]:
+                self.allocate_buffers(*frame.shape[:2])
+            height, width = self.shape # Regions are located at the analysis size
 
-            text = "Unoccupied"
             occupied = False
-            kernel = np.ones((5,5),np.uint8)
-
-            # Resize the frame, convert it to grayscale, filter and blur it
-            logger.debug('////////////////////// filtering 1 //////////////////////')
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-            logger.debug('////////////////////// filtering 1.5 //////////////////////')
-            gray = clahe.apply(gray)
-            gray = cv2.medianBlur(gray,9)  # Filters out noise
-            gray = cv2.GaussianBlur(gray, (11, 11), 0)
-            logger.debug('////////////////////// filtering 2 //////////////////////')
-            # Initialise and build background model useing frame averaging
-            if self.history <= 3: # Let the camera warm up
-                self.currentFrame = gray
-                self.history +=1
-                if get_rects == True: # Return peoplerects without frame
-                    return occupied,  self.peopleRects 
-                else:
-                    return occupied,  frame
-            elif self.history == 4:
-                self.previousFrame = self.currentFrame
-                self.currentFrame = gray      
-                self.meanFrame = cv2.addWeighted(self.previousFrame,0.5,self.currentFrame,0.5,0)
-                self.history +=1
-                if get_rects == True: # Return peoplerects without frame
-                    return occupied,  self.peopleRects 
+
+            # Downsample the frame, convert it to grayscale, filter and blur it
+            gray = self.filter_frame(frame, grayFrame)
+            logger.debug('////////////////////// filtering complete //////////////////////')
+            # Initialise the background model by averaging the first frames
+            if self.history < BACKGROUND_WARMUP: # Let the camera warm up
+                if self.history == 0:
+                    self.background[:] = gray
                 else:
-                    return occupied,  frame
-            elif self.history == 5:
-                self.previousFrame = self.meanFrame
-                self.currentFrame = gray
-                self.meanFrame = cv2.addWeighted(self.previousFrame,0.5,self.currentFrame,0.5,0)
-                # cv2.imwrite("avegrayfiltered.jpg", self.meanFrame)
+                    cv2.accumulateWeighted(gray, self.background, self.learning_rate(False))
                 self.history +=1
                 if get_rects == True: # Return peoplerects without frame
                     return occupied,  self.peopleRects 
                 else:
                     return occupied,  frame
-            elif self.history > 4000 and len(self.peopleRects) == 0: 
-                # Recalculate background model every 4000 frames only if there are no people in frame 
-                self.previousFrame = self.currentFrame
-                self.currentFrame = gray
-                self.history = 0
             logger.debug('////////////////////// averaging complete //////////////////////')
-            # Compute the absolute difference between the current frame and first frame
-            frameDelta = cv2.absdiff(self.meanFrame , gray)
-            thresh = cv2.threshold(frameDelta, 25, 255, cv2.THRESH_BINARY)[1]
-            thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel) # Removes small holes i.e noise
-            thresh = cv2.dilate(thresh, kernel, iterations=3) # Increases white region by saturating blobs
-            cv2.imwrite("motion.jpg", thresh)
-            if cv2_version.startswith("4"):
-                (cnts, _) = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            else:
-                (_, cnts, _) = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            # Compute the absolute difference between the current frame and background model
+            cv2.convertScaleAbs(self.background, dst=self.meanFrame)
+            cv2.absdiff(self.meanFrame, gray, dst=self.frameDelta)
+            cv2.threshold(self.frameDelta, 25, 255, cv2.THRESH_BINARY, dst=self.thresh)
+            cv2.morphologyEx(self.thresh, cv2.MORPH_OPEN, self.kernel, dst=self.scratch) # Removes small holes i.e noise
+            cv2.dilate(self.scratch, self.kernel, dst=self.thresh, iterations=3) # Increases white region by saturating blobs
+            if self.debugDumpInterval and self.history % self.debugDumpInterval == 0:
+                cv2.imwrite("motion.jpg", self.thresh)
+            # Learn how often each pixel moves, then remove chronically active clutter
+            self.update_clutter()
+            if self.suppressClutter:
+                cv2.bitwise_and(self.thresh, self.clutterMask, dst=self.thresh)
+            roiMask = self.roiMask
+            if roiMask is not None: # Ignore motion outside the camera's zones
+                cv2.bitwise_and(self.thresh, roiMask, dst=self.thresh)
+            # Label the foreground blobs, each row of stats holds a blob's bounding box and area
+            count, _, stats, _ = cv2.connectedComponentsWithStats(self.thresh, labels=self.labels, connectivity=8, ltype=cv2.CV_32S)
 
             logger.debug('////////////////////// filtering & thresholding //////////////////////')
+            stats = stats[1:] # Label 0 is the background
+            areas = stats[:, cv2.CC_STAT_AREA]
+            w = stats[:, cv2.CC_STAT_WIDTH]
+            h = stats[:, cv2.CC_STAT_HEIGHT]
+            # Blobs that are too small or too big are ignored
+            candidates = (areas >= self.minArea) & (areas <= self.maxArea)
+            # If a blob is ridiculously big, or its bounding box is equal to the height or most of the 
+            # width of the frame (made smaller never really covers whole width), the scene has most 
+            # likely changed i.e lighting
+            resync = bool(np.any(areas > self.resyncArea) or np.any(candidates & ((h == height) | (w >= width/1.5))))
             self.peopleRects = []
-            # Loop through all contours
-            for c in cnts:
-                # If the contour is too small or too big, ignore it
-                if cv2.contourArea(c) < 2000 or cv2.contourArea(c) > 90000:
-                    if cv2.contourArea(c) > 100000: # If it is ridiculously big reset background model it is likely that something is wrong
-                        self.history = 0
-                        break
-                    continue     
-                (x, y, w, h) = cv2.boundingRect(c)  # Compute the bounding box for the contour
-                # If the bounding box is equal to the width (made smaller never really covers whole width) 
-                # or height of the frame it is likely that something is wrong - reset model
-                if h == height or w >= width/1.5: 
-                        self.history = 0
-                        break
-
-                if (h) > (w):  
-                    occupied = True
-                    if (h) > (1.5*w): # Most likely a person, this can be made strictor (average human ratio 5.9/1.6 = h/w = 3.6875) 
-                        self.person = True
-                    self.peopleRects.append(cv2.boundingRect(c))
+            if not resync:
+                people = candidates & (h > w) 
+                if np.any(people & (h > 1.5*w)): # Most likely a person, this can be made strictor (average human ratio 5.9/1.6 = h/w = 3.6875) 
+                    self.person = True
+                occupied = bool(np.any(people))
+                self.peopleRects = self.to_frame(stats[people, :4]) # x, y, w, h
             logger.debug('////////////////////// Contour area done //////////////////////')
+            if resync:
+                # Whole frame changes are absorbed quickly instead of being reported as motion
+                cv2.accumulateWeighted(gray, self.background, self.learning_rate(True))
+            else:
+                # The background learns at the normal rate outside the foreground and slowly under it,
+                # a hard freeze would report anything left in the scene as motion forever
+                cv2.bitwise_not(self.thresh, dst=self.backgroundMask)
+                cv2.accumulateWeighted(gray, self.background, self.learning_rate(False), mask=self.backgroundMask)
+                cv2.accumulateWeighted(gray, self.background, BACKGROUND_FOREGROUND_LEARNING_RATE, mask=self.thresh)
             self.history +=1
             if get_rects == True: # Return peoplerects without frame
                 return occupied,  self.peopleRects 
@@ -0,0 +1,200 @@
+# OpenFaceEngine.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+import os
+import logging
+
+try:
+    from torch.nn.utils.fusion import fuse_conv_bn_eval
+except ImportError:
+    fuse_conv_bn_eval = None
+
+try:
+    from torch.ao import quantization
+except ImportError:
+    try:
+        from torch import quantization
+    except ImportError:
+        quantization = None
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_THREADS = None # Intra-op threads used for inference, None keeps torch's default of one per core
+IMAGE_SIZE = 96
+CALIBRATION_IMAGES = 64 # Aligned faces the int8 activation ranges are calibrated on
+CALIBRATION_BATCH_SIZE = 16
+
+def preprocess(alignedFace, out):
+    """Converts a BGR aligned face into the network's normalised
+    3x96x96 RGB layout, written into out"""
+    img = cv2.cvtColor(alignedFace, cv2.COLOR_BGR2RGB)
+    img = cv2.resize(img, (IMAGE_SIZE, IMAGE_SIZE), interpolation=cv2.INTER_LINEAR)
+    np.divide(np.transpose(img, (2, 0, 1)), 255.0, out=out, casting='unsafe')
+
+def aligned_images(directory):
+    """Returns a sorted list of (name, path) of the aligned face images
+    in directory, which holds a subdirectory of images per person"""
+    images = []
+    for subdir, dirs, filenames in sorted(os.walk(directory)):
+        for filename in sorted(filenames):
+            if filename.endswith(".jpg") or filename.endswith(".png"):
+                images.append((os.path.basename(subdir), os.path.join(subdir, filename)))
+    return images
+
+def load_faces(paths):
+    """Reads aligned face images into an Nx3x96x96 float tensor,
+    unreadable images are skipped. Returns the tensor and the indices
+    of the paths it holds"""
+    batch = np.empty((len(paths), 3, IMAGE_SIZE, IMAGE_SIZE), dtype=np.float32)
+    read = []
+    for i, path in enumerate(paths):
+        alignedFace = cv2.imread(path)
+        if alignedFace is None:
+            logger.info("Unable to read " + path)
+            continue
+        preprocess(alignedFace, batch[len(read)])
+        read.append(i)
+    return torch.from_numpy(batch[:len(read)]), read
+
+def calibration_faces(directory, count=CALIBRATION_IMAGES):
+    """Up to count aligned faces spread evenly over the images in
+    directory, as an Nx3x96x96 tensor"""
+    images = aligned_images(directory)
+    if len(images) > count:
+        images = [images[i] for i in np.linspace(0, len(images) - 1, count).astype(int)]
+    return load_faces([path for name, path in images])[0]
+
+def fold_batch_norm(module):
+    """Folds every BatchNorm2d that directly follows a Conv2d into the
+    convolution's weights and bias, the BatchNorm is replaced by an
+    identity. In the OpenFace network a BatchNorm always directly
+    follows the convolution it normalises. Returns the number of
+    folded layers"""
+    folded = 0
+    children = list(module.named_children())
+    for (name, child), (nextName, nextChild) in zip(children, children[1:]):
+        if isinstance(child, nn.Conv2d) and isinstance(nextChild, nn.BatchNorm2d):
+            setattr(module, name, fuse_conv_bn_eval(child, nextChild))
+            setattr(module, nextName, nn.Identity())
+            folded += 1
+    for name, child in module.named_children():
+        folded += fold_batch_norm(child)
+    return folded
+
+def quantized_engine():
+    """The int8 backend to quantise for, None if torch has none"""
+    if quantization is None:
+        return None
+    for engine in ('fbgemm', 'qnnpack'): # fbgemm is the x86 backend, qnnpack the ARM one
+        if engine in torch.backends.quantized.supported_engines:
+            return engine
+    return None
+
+def quantize(model, calibration, batchSize=CALIBRATION_BATCH_SIZE):
+    """Quantises the convolutions of a BatchNorm folded model to int8.
+    Each convolution is wrapped to quantise its input and
+    dequantise its output, so the pooling, LRN and concatenation
+    between them stay float. Activation ranges are calibrated by
+    running calibration, an Nx3x96x96 tensor of aligned faces, through
+    the model. The final Linear layer is quantised dynamically.
+    Returns the quantised model"""
+    engine = quantized_engine()
+    torch.backends.quantized.engine = engine
+    qconfig = quantization.get_default_qconfig(engine)
+
+    def wrap(module):
+        for name, child in module.named_children():
+            if isinstance(child, nn.Conv2d):
+                wrapper = quantization.QuantWrapper(child)
+                wrapper.qconfig = qconfig # Only the wrapped convolutions are statically quantised
+                setattr(module, name, wrapper)
+            else:
+                wrap(child)
+    wrap(model)
+
+    quantization.prepare(model, inplace=True)
+    with torch.no_grad():
+        for batch in torch.split(calibration, batchSize):
+            model(batch)
+    quantization.convert(model, inplace=True)
+    return quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+class OpenFaceEngine(object):
+    """The OpenFaceEngine runs the OpenFace embedding network for CPU
+    inference. Autograd is disabled, BatchNorm layers are folded into
+    the preceding convolutions, weights and inputs use the channels
+    last memory layout and the network is traced into a frozen
+    TorchScript graph. If calibration faces are given the convolutions
+    and the final Linear layer are quantised to int8, trading a small
+    embedding drift for faster inference. Each optimisation is skipped
+    if the installed torch does not support it. It is called like the
+    network it wraps and returns Nx128 embeddings"""
+
+    def __init__(self, model, threads=INFERENCE_THREADS, foldBatchNorm=True, channelsLast=True, trace=True, calibration=None):
+        if threads:
+            torch.set_num_threads(threads)
+        model = model.cpu().eval()
+        self.channelsLast = channelsLast and hasattr(torch, 'channels_last')
+        self.traced = False
+        self.quantized = False
+
+        if foldBatchNorm and fuse_conv_bn_eval is not None:
+            logger.info("Folded {} BatchNorm layers into convolutions".format(fold_batch_norm(model)))
+        if calibration is not None:
+            if quantized_engine() is None:
+                logger.warning("The installed torch cannot quantise, the OpenFace network stays float")
+            elif len(calibration) == 0:
+                logger.warning("No calibration faces, the OpenFace network stays float")
+            else:
+                model = quantize(model, calibration)
+                self.quantized = True
+        if self.channelsLast and not self.quantized: # Quantised weights are packed in the backend's own layout
+            model = model.to(memory_format=torch.channels_last)
+        if trace:
+            try:
+                model = self.trace(model)
+                self.traced = True
+            except Exception as e: # The eager model still benefits from the other optimisations
+                logger.warning("Could not trace the OpenFace network, running it eagerly: " + str(e))
+        self.model = model
+        logger.info("OpenFace CPU engine ready: {} threads, channels last {}, traced {}, int8 {}".format(
+            torch.get_num_threads(), self.channelsLast, self.traced, self.quantized))
+
+    def prepare(self, batch):
+        if self.channelsLast:
+            return batch.contiguous(memory_format=torch.channels_last)
+        return batch
+
+    def trace(self, model):
+        example = self.prepare(torch.rand(2, 3, IMAGE_SIZE, IMAGE_SIZE))
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+        if hasattr(torch.jit, 'freeze'):
+            traced = torch.jit.freeze(traced)
+        if hasattr(torch.jit, 'optimize_for_inference') and not self.quantized: # Its passes target float graphs
+            traced = torch.jit.optimize_for_inference(traced)
+        with torch.no_grad(): # The first calls of a TorchScript graph optimise it
+            for _ in range(2):
+                traced(example)
+        return traced
+
+    def forward(self, batch):
+        with torch.no_grad():
+            return self.model(self.prepare(batch))
+
+    __call__ = forward
@@ -0,0 +1,45 @@
+# SpatialCrossMapLRN.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+class SpatialCrossMapLRN(nn.Module):
+    """Cross channel local response normalisation as in Torch's
+    nn.SpatialCrossMapLRN, which the OpenFace weights were trained
+    with. Every value is divided by (k + alpha / size * the sum of the
+    squares of the size channels centred on its channel) ^ beta. The
+    window sums of all channels are the difference of a cumulative sum
+    over the zero padded squares, so the module runs as a handful of
+    tensor operations for any batch size and can be traced"""
+
+    def __init__(self, size, alpha=1e-4, beta=0.75, k=1.0):
+        super(SpatialCrossMapLRN, self).__init__()
+        self.size = size
+        self.alpha = alpha
+        self.beta = beta
+        self.k = k
+
+    def forward(self, input):
+        before, after = self.size // 2, (self.size - 1) // 2
+        # One extra leading zero channel so the first window is a difference too
+        squares = F.pad(input * input, (0, 0, 0, 0, before + 1, after))
+        cumulative = torch.cumsum(squares, 1)
+        windows = cumulative[:, self.size:] - cumulative[:, :-self.size]
+        scale = windows * (self.alpha / self.size) + self.k
+        return input * scale.pow(-self.beta)
+
+    def extra_repr(self):
+        return "{}, alpha={}, beta={}, k={}".format(self.size, self.alpha, self.beta, self.k)
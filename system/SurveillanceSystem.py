@@ -43,7 +43,10 @@ from datetime import datetime, timedelta
 import requests
 import json
 import Camera
+import CameraWorker
+import EmbeddingCache
 import FaceRecogniser
+import TrainingJob
 import ImageUtils
 import random
 #
@@ -112,6 +115,7 @@ class SurveillanceSystem(object):
     def __init__(self):
 
         self.recogniser = FaceRecogniser.FaceRecogniser()
+        self.trainingJob = TrainingJob.TrainingJob(self.recogniser, self.reload_worker_classifiers) # Retrains the classifier in the background
         self.trainingEvent = threading.Event() # Used to holt processing while training the classifier 
         self.trainingEvent.set() 
         self.drawing = True 
@@ -123,6 +127,7 @@ class SurveillanceSystem(object):
         self.cameraProcessingThreads = []
         self.peopleDB = []
         self.confidenceThreshold = 50 # Used as a threshold to classify a person as unknown
+        self.processingMode = "thread" # "thread" processes cameras in this process, "process" in CameraWorker processes
 
         # Initialization of alert processing thread 
         self.alertsLock = threading.Lock()
@@ -150,10 +155,40 @@ class SurveillanceSystem(object):
         
         # processing frame threads 
         for i, cam in enumerate(self.cameras):       
-          thread = threading.Thread(name='frame_process_thread_' + str(i),target=self.process_frame,args=(cam,))
-          thread.daemon = False
-          self.cameraProcessingThreads.append(thread)
-          thread.start()
+          self.cameraProcessingThreads.append(self.start_processing(cam, i))
+
+    def start_processing(self, camera, camNum):
+        """Starts processing a camera in a thread, or in a CameraWorker 
+        process when the system is in process mode"""
+        if self.processingMode == "process":
+            return CameraWorker.CameraWorker(self, camera)
+        thread = threading.Thread(name='frame_process_thread_' + str(camNum),target=self.process_frame,args=(camera,))
+        thread.daemon = False
+        thread.start()
+        return thread
+
+    def camera_workers(self):
+        """The CameraWorkers of cameras processed in worker processes"""
+        return [camera.worker for camera in list(self.cameras) if camera.worker is not None]
+
+    def embedding_cache_stats(self):
+        """Stats of the embedding caches of this process and of every
+        CameraWorker, which recognise faces in their own copy of the cache"""
+        stats = [self.recogniser.cache.stats()]
+        stats += [worker.embeddingCache for worker in self.camera_workers() if worker.embeddingCache is not None]
+        return EmbeddingCache.combine_stats(stats)
+
+    def reload_worker_classifiers(self, path):
+        """Swaps a retrained classifier into every CameraWorker's recogniser"""
+        for worker in self.camera_workers():
+            worker.reload_classifier(path)
+
+    def set_quantized(self, quantized):
+        """Switches every recogniser, including those of the CameraWorkers,
+        between the float and the int8 OpenFace network"""
+        self.recogniser.set_quantized(quantized)
+        for worker in self.camera_workers():
+            worker.set_quantized(quantized)
 
     def _read_config(self):
         if not os.path.isfile('config.json'): 
@@ -161,6 +196,9 @@ class SurveillanceSystem(object):
         
         with open('config.json') as json_file:
             config = json.load(json_file)
+            self.processingMode = config.get("processingMode", "thread")
+            self.recogniser.useGallery = config.get("recognitionMode", "svm") == "gallery"
+            self.recogniser.set_quantized(config.get("embeddingModel", "float") == "int8")
             for cam in config["cameras"]:
                 print("cam", cam)
                 dlibDetection = False
@@ -169,7 +207,11 @@ class SurveillanceSystem(object):
                 fpsTweak = False
                 if cam["fpsTweak"].lower() == "true":
                     fpsTweak = True
-                self.cameras.append(Camera.IPCamera(cam["url"], cam["cameraFunction"], dlibDetection, fpsTweak))
+                self.cameras.append(Camera.IPCamera(cam["url"], cam["cameraFunction"], dlibDetection, fpsTweak,
+                                                    sharedMemory=self.processingMode == "process",
+                                                    motionAnalysisWidth=int(cam.get("motionAnalysisWidth", 
+                                                                                    Camera.MotionDetector.ANALYSIS_WIDTH)),
+                                                    zones=cam.get("zones", [])))
             for al in config["alerts"]:
                 print("alert", al)
                 self.alerts.append(Alert(al["alarmState"], 
@@ -182,14 +224,19 @@ class SurveillanceSystem(object):
     
     def write_config(self):
         config = {}
+        config["processingMode"] = self.processingMode
+        config["recognitionMode"] = "gallery" if self.recogniser.useGallery else "svm"
+        config["embeddingModel"] = "int8" if self.recogniser.quantized else "float"
         config["cameras"] = []
         config["alerts"] = []
-        # Camera: url, cameraFunction, dlibDetection, fpsTweak
+        # Camera: url, cameraFunction, dlibDetection, fpsTweak, motionAnalysisWidth, zones
         for cam in self.cameras:
             config["cameras"].append({"url": cam.url, 
                                       "cameraFunction": cam.cameraFunction,
                                       "dlibDetection": cam.dlibDetection,
-                                      "fpsTweak": cam.fpsTweak})
+                                      "fpsTweak": cam.fpsTweak,
+                                      "motionAnalysisWidth": cam.motionDetector.analysisWidth,
+                                      "zones": cam.zones.zones})
         # Alert: alarmState, camera, event, person, actions, emailAddress, confidence
         for al in self.alerts:
             config["alerts"].append({"alarmState": al.alarmState, 
@@ -208,13 +255,7 @@ class SurveillanceSystem(object):
         frame processing thread"""
         print("add_camerea - {}".format(camera))
         self.cameras.append(camera)
-        thread = threading.Thread(name='frame_process_thread_' + 
-                                 str(len(self.cameras)),
-                                 target=self.process_frame,
-                                 args=(self.cameras[-1],))
-        thread.daemon = False
-        self.cameraProcessingThreads.append(thread)
-        thread.start()
+        self.cameraProcessingThreads.append(self.start_processing(camera, len(self.cameras)))
 
     def remove_camera(self, camID):
         """remove a camera to the System and kill its processing thread"""
@@ -223,11 +264,32 @@ class SurveillanceSystem(object):
             cid = camID.split("_")[1]
         else:
             cid = camID
-        cam = self.cameras[int(cid)]
-        cam.captureThread.stop = False
-        self.cameras.pop(int(cid))
-        self.cameraProcessingThreads.pop(int(cid))
-        #self.captureThread.stop = False
+        cam = self.cameras.pop(int(cid))
+        processing = self.cameraProcessingThreads.pop(int(cid))
+        if isinstance(processing, CameraWorker.CameraWorker):
+            processing.stop()
+        cam.stop() # Processing threads exit when they see the capture thread's stop flag
+
+    def detect_zone_faces(self, camera, frame):
+        """Detects faces in the bounding box of the camera's zones 
+        rather than the whole frame, faces centred outside the zones 
+        are dropped. Boxes are returned in frame coordinates"""
+        height, width = frame.shape[:2]
+        box = camera.zones.bounding_box(height, width) if camera.zones else None
+        if box is None:
+            return camera.faceDetector.detect_faces(frame, camera.dlibDetection)
+        bx, by, bw, bh = box
+        if bw == 0 or bh == 0:
+            return []
+        faceBoxes = camera.faceDetector.detect_faces(frame[by:by+bh, bx:bx+bw], camera.dlibDetection)
+        if camera.dlibDetection:
+            faceBoxes = [dlib.rectangle(bb.left() + bx, bb.top() + by, bb.right() + bx, bb.bottom() + by) for bb in faceBoxes]
+            return [bb for bb in faceBoxes 
+                    if camera.zones.contains(height, width, (bb.left() + bb.right()) // 2, (bb.top() + bb.bottom()) // 2)]
+        faceBoxes = faceBoxes + np.array([bx, by, 0, 0], dtype=np.int32)
+        centres = faceBoxes[:, :2] + faceBoxes[:, 2:] // 2
+        np.clip(centres, 0, [width - 1, height - 1], out=centres)
+        return faceBoxes[camera.zones.mask(height, width)[centres[:, 1], centres[:, 0]] != 0]
 
     def process_frame(self,camera):
         """This function performs all the frame proccessing.
@@ -239,15 +301,15 @@ class SurveillanceSystem(object):
         FPScount = 0 # Used to calculate frame rate at which frames are being processed
         FPSstart = time.time()
         start = time.time()
-        stop = camera.captureThread.stop
+        frameSeq = 0 # Sequence number of the last frame read from the camera's frame buffer
         
-        while not stop:
+        while not camera.captureThread.stop:
 
             frame_count +=1
             logger.debug("Reading Frame")
-            frame = camera.read_frame()
-            # Checks to see if the new frame is the same as the previous frame
-            if (frame is None) or np.array_equal(frame, camera.tempFrame):
+            # Blocks until a frame newer than the last one processed has been captured, None on timeout
+            frameSeq, frame = camera.read_frame_after(frameSeq)
+            if frame is None:
                 continue
             frame = ImageUtils.resize(frame)
             height, width, channels = frame.shape
@@ -259,7 +321,6 @@ class SurveillanceSystem(object):
                 FPScount = 0
 
             FPScount += 1
-            camera.tempFrame = frame
         
             ####################
             # MOTION DETECTION #
@@ -284,7 +345,7 @@ class SurveillanceSystem(object):
                 training_blocker = self.trainingEvent.wait()  
 
                 #rgbFrame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                camera.faceBoxes = camera.faceDetector.detect_faces(frame, camera.dlibDetection) 
+                camera.faceBoxes = self.detect_zone_faces(camera, frame) 
                 if self.drawing == True:
                     frame = ImageUtils.draw_boxes(frame, camera.faceBoxes, camera.dlibDetection)
                     #frame = ImageUtils.draw_boxes(frame, camera.faceBoxes, True) # OpenCV DNN returns dlib.rectangle
@@ -293,6 +354,7 @@ class SurveillanceSystem(object):
                     print('////  FACES DETECTED: '+ str(len(camera.faceBoxes)) +' //')
                     logger.info('////  FACES DETECTED: '+ str(len(camera.faceBoxes)) +' //')
 
+                    faceBbs = []
                     for face_bb in camera.faceBoxes: 
                         # Used to reduce false positives from opencv haar cascade detector.
                         # If face isn't detected using more rigorous paramters in the detectMultiscale() 
@@ -303,9 +365,14 @@ class SurveillanceSystem(object):
                         faceimg = ImageUtils.crop(frame, face_bb, dlibRect = camera.dlibDetection)
                         if len(camera.faceDetector.detect_cascadeface_accurate(faceimg)) == 0:
                             continue
+                        faceBbs.append(face_bb)
 
-                        # returns a dictionary that contains name, confidence and representation and an alignedFace (numpy array)
-                        predictions, alignedFace = self.recogniser.make_prediction(frame, face_bb) 
+                    # All faces in the frame are recognised together, returns a dictionary that contains 
+                    # name, confidence and representation and an alignedFace (numpy array) per face
+                    for result in self.recogniser.make_predictions(frame, faceBbs, camera.url):
+                        if result is None:
+                            continue
+                        predictions, alignedFace = result
 
                         with camera.peopleDictLock:
                             # If the person has already been detected and his new confidence is greater 
@@ -356,7 +423,7 @@ class SurveillanceSystem(object):
                         frame_count += 1
 
                     #frame = cv2.flip(frame, 1)
-                    camera.faceBoxes = camera.faceDetector.detect_faces(frame,camera.dlibDetection)
+                    camera.faceBoxes = self.detect_zone_faces(camera, frame)
                     if self.drawing == True:
                         frame = ImageUtils.draw_boxes(frame, camera.faceBoxes, camera.dlibDetection)
                  
@@ -370,6 +437,7 @@ class SurveillanceSystem(object):
                     else:
                         logger.info('////  FACES DETECTED: '+ str(len(camera.faceBoxes)) +' ////')
                         # frame = cv2.flip(frame, 1)
+                        faceBbs = []
                         for face_bb in camera.faceBoxes: 
                       
                             if camera.dlibDetection == False:
@@ -378,8 +446,14 @@ class SurveillanceSystem(object):
                                 faceimg = ImageUtils.crop(frame, face_bb, dlibRect = True)
                                 if len(camera.faceDetector.detect_cascadeface_accurate(faceimg)) == 0:
                                     continue
+                            faceBbs.append(face_bb)
+                        # Regions where faces are found are never learnt as motion clutter
+                        camera.motionDetector.report_faces([(bb.left(), bb.top(), bb.width(), bb.height()) for bb in faceBbs])
 
-                            predictions, alignedFace = self.recogniser.make_prediction(frame,face_bb)
+                        for result in self.recogniser.make_predictions(frame, faceBbs, camera.url):
+                            if result is None:
+                                continue
+                            predictions, alignedFace = result
 
                             with camera.peopleDictLock:
                                 if predictions['name'] in camera.people:
@@ -427,14 +501,18 @@ class SurveillanceSystem(object):
                     if self.drawing == True:
                         frame = ImageUtils.draw_boxes(frame, peopleRects, False)
 
-                    for x, y, w, h in peopleRects:
+                    # Overlapping regions are merged and the number of crops is capped, 
+                    # the whole frame is searched at once if the regions cover most of it
+                    regions = ImageUtils.detection_regions(peopleRects, width, height)
+                    personimgs = [cv2.flip(ImageUtils.crop(frame, dlib.rectangle(int(x), int(y), int(x+w), int(y+h)), dlibRect = True), 1)
+                                  for x, y, w, h in regions]
+                    # Faces are detected in all regions with a single forward pass
+                    regionFaces = camera.faceDetector.detect_faces_batch(personimgs, camera.dlibDetection)
+                    for (x, y, w, h), personimg, faceBoxes in zip(regions, personimgs, regionFaces):
                       
                         logger.debug('//// Proccessing People Segmented Areas ///')
-                        bb = dlib.rectangle(int(x), int(y), int(x+w), int(y+h)) 
-                        personimg = ImageUtils.crop(frame, bb, dlibRect = True)
-                       
-                        personimg = cv2.flip(personimg, 1)
-                        camera.faceBoxes = camera.faceDetector.detect_faces(personimg,camera.dlibDetection)
+                        personRect = (x, y, w, h)
+                        camera.faceBoxes = faceBoxes
                         if self.drawing == True:
                             camera.processing_frame = ImageUtils.draw_boxes(frame, peopleRects, False)
 
@@ -447,8 +525,9 @@ class SurveillanceSystem(object):
                                     if len(camera.faceDetector.detect_cascadeface_accurate(faceimg)) == 0:
                                           continue
                               logger.info('/// Proccessing Detected faces ///')
+                              camera.motionDetector.report_faces([ImageUtils.region_to_frame(personRect, face_bb, flipped=True)]) # Never learnt as clutter, the crop was mirrored
 
-                              predictions, alignedFace = self.recogniser.make_prediction(personimg,face_bb)
+                              predictions, alignedFace = self.recogniser.make_prediction(personimg, face_bb, camera.url)
 
                               with camera.peopleDictLock:
                                 if predictions['name'] in camera.people:
@@ -500,10 +579,16 @@ class SurveillanceSystem(object):
 
                 logger.debug('//// MOTION DETECTED //////')
              
-                for x, y, w, h in peopleRects:
+                # Overlapping regions of one person are merged so each is only searched once
+                regions = ImageUtils.detection_regions(peopleRects, width, height, allowFullFrame=False)
+                personimgs = [ImageUtils.crop(frame, (int(x), int(y), int(w), int(h))) for x, y, w, h in regions] # Crop regions of interest 
+                # Every region is searched for faces whether it is tracked or not, 
+                # so all regions are detected with a single forward pass
+                regionFaces = camera.faceDetector.detect_faces_batch(personimgs, camera.dlibDetection)
+                for (x, y, w, h), personimg, faceBoxes in zip(regions, personimgs, regionFaces):
                     peopleFound = True
-                    #person_bb = dlib.rectangle(int(x), int(y), int(x+w), int(y+h)) 
-                    personimg = ImageUtils.crop(frame, person_bb)   # Crop regions of interest 
+                    personRect = (x, y, w, h)
+                    person_bb = dlib.rectangle(int(x), int(y), int(x+w), int(y+h)) 
                     #personimg = cv2.flip(personimg, 1) 
                     tracked = False
                     
@@ -513,7 +598,7 @@ class SurveillanceSystem(object):
                             logger.debug("=> Updating Tracker <=")
                             camera.trackers[i].update_tracker(person_bb)
                             # personimg = cv2.flip(personimg, 1)
-                            camera.faceBoxes = camera.faceDetector.detect_faces(personimg, camera.dlibDetection)  
+                            camera.faceBoxes = faceBoxes
                             logger.debug('//////  FACES DETECTED: '+ str(len(camera.faceBoxes)) +' /////')
                             if len(camera.faceBoxes) > 0:
                                 logger.info("Found " + str(len(camera.faceBoxes)) + " faces.")
@@ -524,8 +609,9 @@ class SurveillanceSystem(object):
                                 faceimg = ImageUtils.crop(personimg, face_bb)
                                 if len(camera.faceDetector.detect_cascadeface_accurate(faceimg)) == 0:
                                     continue
+                                camera.motionDetector.report_faces([ImageUtils.region_to_frame(personRect, face_bb)]) # Never learnt as motion clutter
 
-                                predictions, alignedFace =  self.recogniser.make_prediction(personimg, face_bb)
+                                predictions, alignedFace =  self.recogniser.make_prediction(personimg, face_bb, camera.url)
                         
                                 if predictions['confidence'] > self.confidenceThreshold:
                                     predictedName = predictions['name']
@@ -625,8 +711,8 @@ class SurveillanceSystem(object):
 
                     # If the region is not being tracked
                     if not tracked:
-                        # Look for faces in the cropped image of the region
-                        camera.faceBoxes = camera.faceDetector.detect_faces(personimg,camera.dlibDetection)
+                        # Faces found in the cropped image of the region
+                        camera.faceBoxes = faceBoxes
                        
                         for face_bb in camera.faceBoxes:
                             if camera.dlibDetection == False:
@@ -636,8 +722,9 @@ class SurveillanceSystem(object):
                                 faceimg = ImageUtils.crop(personimg, face_bb, dlibRect = True)
                                 if len(camera.faceDetector.detect_cascadeface_accurate(faceimg)) == 0:
                                     continue
+                            camera.motionDetector.report_faces([ImageUtils.region_to_frame(personRect, face_bb)]) # Never learnt as motion clutter
 
-                            predictions, alignedFace =  self.recogniser.make_prediction(personimg,face_bb)
+                            predictions, alignedFace =  self.recogniser.make_prediction(personimg, face_bb, camera.url)
                 
                             alreadyBeenDetected = False
                             with camera.peopleDictLock:
@@ -853,6 +940,10 @@ class SurveillanceSystem(object):
 
         logger.info( "Writing Image To Directory: " + name)
         cv2.imwrite(path+name+"/"+ name + "_"+str(num) + ".png", image)
+        if upload == False: # Aligned faces can be enrolled in the gallery without retraining
+            self.recogniser.enroll_face(name, image)
+            for worker in self.camera_workers(): # Their recognisers hold a copy of the gallery
+                worker.reload_gallery()
         self.get_face_database_names()
 
         return True
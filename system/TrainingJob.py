@@ -0,0 +1,96 @@
+# TrainingJob.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from subprocess import Popen, PIPE
+import threading
+import json
+import time
+import sys
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+fileDir = os.path.dirname(os.path.realpath(__file__))
+
+STATUS_PREFIX = "TRAINING_STATUS " # Marks progress lines printed by the training process
+
+class TrainingJob(object):
+    """The TrainingJob object retrains the classifier in the
+    background. Alignment, embedding generation and fitting run in a
+    separate python process (FaceRecogniser.py run as a script) which
+    writes a versioned classifier. Once it has finished the new
+    classifier is swapped into the running FaceRecogniser, so cameras
+    keep detecting and recognising with the old classifier meanwhile.
+    reloaded is called with the classifier's path once it has been
+    swapped in, so it can be loaded by CameraWorker processes too.
+    The job's progress can be read from status()"""
+
+    def __init__(self, recogniser, reloaded=None):
+        self.recogniser = recogniser
+        self.reloaded = reloaded
+        self.lock = threading.Lock()
+        self.process = None
+        self.state = {'state': 'idle', 'stage': None, 'done': 0, 'total': 0,
+                      'classifier': None, 'started': None, 'finished': None, 'error': None}
+
+    def start(self):
+        """Starts a retrain, returns False if one is already running"""
+        with self.lock:
+            if self.state['state'] == 'running':
+                return False
+            self.state = {'state': 'running', 'stage': 'starting', 'done': 0, 'total': 0,
+                          'classifier': None, 'started': time.time(), 'finished': None, 'error': None}
+            self.process = Popen([sys.executable, os.path.join(fileDir, 'FaceRecogniser.py')],
+                                 cwd=fileDir, stdout=PIPE, universal_newlines=True)
+        logger.info("Started classifier training process " + str(self.process.pid))
+        thread = threading.Thread(name='training_monitor_thread_', target=self.monitor)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def monitor(self):
+        """Follows the training process' progress and swaps the new
+        classifier in once it has been written"""
+        for line in self.process.stdout:
+            if not line.startswith(STATUS_PREFIX):
+                continue
+            status = json.loads(line[len(STATUS_PREFIX):])
+            with self.lock:
+                self.state.update(status)
+        returncode = self.process.wait()
+
+        error = None
+        if returncode != 0 or not self.state['classifier']:
+            error = "Training process exited with code " + str(returncode)
+        else:
+            try:
+                self.recogniser.reloadClassifier(self.state['classifier'])
+                if self.reloaded is not None:
+                    self.reloaded(self.state['classifier'])
+            except Exception as e:
+                error = "Could not load " + str(self.state['classifier']) + ": " + str(e)
+
+        with self.lock:
+            self.state['finished'] = time.time()
+            self.state['state'] = 'failed' if error else 'finished'
+            self.state['error'] = error
+        if error:
+            logger.error(error)
+        else:
+            logger.info("Swapped in classifier " + self.state['classifier'])
+
+    def status(self):
+        with self.lock:
+            return dict(self.state)
@@ -109,8 +109,12 @@ def gen(camera):
     however slows down streaming and therefore read_jpg()
     is recommended"""
     #print("camera", camera)
+    seq = 0
     while True:
-        frame = camera.read_processed()    # read_jpg()  
+        # Blocks until the camera publishes a new frame instead of re-encoding the same one
+        seq, frame = camera.read_processed_after(seq)    # read_jpg_after(seq)  
+        if frame is None:
+            continue
         # Builds 'jpeg' data with header and payload
         yield (b'--frame\r\n'
                b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n\r\n')  
@@ -136,7 +140,10 @@ def system_monitoring():
         for camera in HomeSurveillance.cameras:    
             cameraProcessingFPS.append("{0:.2f}".format(camera.processingFPS))
             app.logger.info("FPS: " +str(camera.processingFPS) + " " + str(camera.streamingFPS))
-        systemState = {'cpu':cpu_usage(),'memory':memory_usage(), 'processingFPS': cameraProcessingFPS}
+        embeddingCache = HomeSurveillance.embedding_cache_stats() # Summed over the camera worker processes
+        app.logger.info("Embedding cache hit rate {:.1%}, saved {:.1f}s".format(embeddingCache['hitRate'], embeddingCache['savedSeconds']))
+        systemState = {'cpu':cpu_usage(),'memory':memory_usage(), 'processingFPS': cameraProcessingFPS,
+                       'embeddingCache': embeddingCache}
         socketio.emit('system_monitoring', json.dumps(systemState) ,namespace='/surveillance')
         time.sleep(3)
 
@@ -162,7 +169,8 @@ def add_camera():
         detectionMethod = request.form.get('detectionMethod')
         fpsTweak = request.form.get('fpstweak')
         with HomeSurveillance.camerasLock :
-            HomeSurveillance.add_camera(SurveillanceSystem.Camera.IPCamera(camURL,application,detectionMethod,fpsTweak))
+            HomeSurveillance.add_camera(SurveillanceSystem.Camera.IPCamera(camURL,application,detectionMethod,fpsTweak,
+                                                                           sharedMemory=HomeSurveillance.processingMode == "process"))
         data = {"camNum": len(HomeSurveillance.cameras) -1}
         app.logger.info("Addding a new camera with url: ")
         app.logger.info(camURL)
@@ -186,6 +194,39 @@ def remove_camera():
         return jsonify(data)
     return render_template('index.html')
 
+@app.route('/camera_zones/<camNum>', methods = ['GET','POST'])
+def camera_zones(camNum):
+    """Returns or replaces the include/exclude zones of a camera. Zones are
+    posted as json i.e {"zones": [{"type": "include", "points": [[x, y], ...]}]}
+    with points given as fractions (0-1) of the frame's width and height"""
+    camera = HomeSurveillance.cameras[int(camNum)]
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or "zones" not in body: # Zones are only cleared by an explicit "zones": []
+            return jsonify({"error": "expected a json body with a zones list"}), 400
+        zones = body["zones"]
+        try:
+            with HomeSurveillance.camerasLock:
+                camera.set_zones(zones)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        app.logger.info("Updated zones of camera " + str(camNum))
+        HomeSurveillance.write_config()
+    return jsonify({"zones": camera.zones.zones})
+
+@app.route('/embedding_model', methods = ['GET','POST'])
+def embedding_model():
+    """Returns or switches the OpenFace network faces are embedded with,
+    posted as json i.e {"embeddingModel": "int8"} or {"embeddingModel": "float"}"""
+    if request.method == 'POST':
+        model = (request.get_json(silent=True) or {}).get("embeddingModel")
+        if model not in ("float", "int8"):
+            return jsonify({"error": "embeddingModel must be float or int8"}), 400
+        HomeSurveillance.set_quantized(model == "int8")
+        app.logger.info("Embedding with the " + model + " OpenFace network")
+        HomeSurveillance.write_config()
+    return jsonify({"embeddingModel": "int8" if HomeSurveillance.recogniser.quantized else "float"})
+
 @app.route('/create_alert', methods = ['GET','POST'])
 def create_alert():
     if request.method == 'POST':
@@ -237,13 +278,12 @@ def remove_face():
         predicted_name = request.form.get('predicted_name')
         camNum = request.form.get('camera')
 
-        with HomeSurveillance.cameras[int(camNum)].peopleDictLock:
-            try:
-                del HomeSurveillance.cameras[int(camNum)].people[predicted_name]
-                app.logger.info("==== REMOVED: " + predicted_name + "===")
-            except Exception as e:
-                app.logger.error("ERROR could not remove Face" + e)
-                pass
+        try:
+            HomeSurveillance.cameras[int(camNum)].remove_person(predicted_name)
+            app.logger.info("==== REMOVED: " + predicted_name + "===")
+        except Exception as e:
+            app.logger.error("ERROR could not remove Face" + e)
+            pass
 
         data = {"face_removed":  'true'}
         return jsonify(data)
@@ -258,13 +298,13 @@ def add_face():
         camNum = request.form.get('camera')
         img = None
         
-        with HomeSurveillance.cameras[int(camNum)].peopleDictLock:  
-            try:  
+        try:  
+            with HomeSurveillance.cameras[int(camNum)].peopleDictLock:  
                 img = HomeSurveillance.cameras[int(camNum)].people[person_id].face   # Gets face of person detected in cameras 
                 predicted_name = HomeSurveillance.cameras[int(camNum)].people[person_id].identity
-                del HomeSurveillance.cameras[int(camNum)].people[person_id]    # Removes face from people detected in all cameras 
-            except Exception as e:
-                app.logger.error("ERROR could not add Face" + e)
+            HomeSurveillance.cameras[int(camNum)].remove_person(person_id)    # Removes face from people detected in all cameras 
+        except Exception as e:
+            app.logger.error("ERROR could not add Face" + e)
  
         #print "trust " + str(trust)
         app.logger.info("trust " + str(trust))
@@ -283,15 +323,18 @@ def add_face():
 @app.route('/retrain_classifier', methods = ['GET','POST'])
 def retrain_classifier():
     if request.method == 'POST':
-        app.logger.info("retrain button pushed. clearing event in surveillance objt and calling trainingEvent")
-        HomeSurveillance.trainingEvent.clear() # Block processing threads
-        retrained = HomeSurveillance.recogniser.trainClassifier() #calling the module in FaceRecogniser to start training
-        HomeSurveillance.trainingEvent.set() # Release processing threads       
-        data = {"finished":  retrained}
-        app.logger.info("Finished re-training")
+        app.logger.info("retrain button pushed. starting a background training job")
+        # Training runs in another process, cameras keep recognising with the current classifier
+        started = HomeSurveillance.trainingJob.start()
+        data = {"started":  started}
         return jsonify(data)
     return render_template('index.html')
 
+@app.route('/training_status')
+def training_status():
+    """Returns the state and progress of the current or last training job"""
+    return jsonify(HomeSurveillance.trainingJob.status())
+
 @app.route('/get_faceimg/<name>')
 def get_faceimg(name):  
     key,camNum = name.split("_")
@@ -0,0 +1,97 @@
+# ZoneMask.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cv2
+import numpy as np
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+ZONE_TYPES = ("include", "exclude")
+
+class ZoneMask(object):
+    """The ZoneMask object restricts processing of a camera to the
+    parts of its view that matter. Zones are polygons with points
+    given as fractions (0-1) of the frame's width and height, so they
+    apply at any resolution, i.e {"type": "include", "points": [[0.1, 0.2],
+    [0.5, 0.2], [0.5, 0.9]]}. If there are include zones only their
+    area is processed, exclude zones are removed from it. Binary masks
+    and the bounding box of the processed area are computed once per
+    frame size and cached"""
+
+    def __init__(self, zones=None):
+        self.zones = ZoneMask.validate(zones if zones is not None else [])
+        self.masks = {} # (height, width) -> uint8 mask, 255 where frames are processed
+        self.boxes = {} # (height, width) -> bounding box of the processed area
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.zones)
+
+    @staticmethod
+    def validate(zones):
+        """Returns the zones in canonical form, raises ValueError if they are malformed"""
+        if not isinstance(zones, list):
+            raise ValueError("zones must be a list")
+        valid = []
+        for zone in zones:
+            if not isinstance(zone, dict) or zone.get("type") not in ZONE_TYPES:
+                raise ValueError("every zone needs a type of " + " or ".join(ZONE_TYPES))
+            points = np.asarray(zone.get("points", []), dtype=np.float64)
+            if points.ndim != 2 or points.shape[1] != 2 or len(points) < 3:
+                raise ValueError("every zone needs at least 3 [x, y] points")
+            if np.any(points < 0) or np.any(points > 1):
+                raise ValueError("zone points must be fractions of the frame size between 0 and 1")
+            valid.append({"type": zone["type"], "points": points.tolist()})
+        return valid
+
+    def mask(self, height, width):
+        """Returns a uint8 mask of the frame size, 255 where frames are processed"""
+        with self.lock:
+            if (height, width) not in self.masks:
+                self.masks[(height, width)] = self._build_mask(height, width)
+            return self.masks[(height, width)]
+
+    def _build_mask(self, height, width):
+        scale = np.array([width - 1, height - 1], dtype=np.float64)
+        polygons = {zoneType: [np.round(np.array(zone["points"]) * scale).astype(np.int32)
+                               for zone in self.zones if zone["type"] == zoneType]
+                    for zoneType in ZONE_TYPES}
+        if polygons["include"]:
+            mask = np.zeros((height, width), dtype=np.uint8)
+            cv2.fillPoly(mask, polygons["include"], 255)
+        else:
+            mask = np.full((height, width), 255, dtype=np.uint8)
+        if polygons["exclude"]:
+            cv2.fillPoly(mask, polygons["exclude"], 0)
+        return mask
+
+    def bounding_box(self, height, width):
+        """Returns the (x, y, w, h) bounding box of the processed area,
+        None if it is the whole frame. The box is empty if zones exclude
+        the whole frame"""
+        mask = self.mask(height, width)
+        with self.lock:
+            if (height, width) not in self.boxes:
+                box = cv2.boundingRect(cv2.findNonZero(mask)) if np.any(mask) else (0, 0, 0, 0)
+                self.boxes[(height, width)] = None if box == (0, 0, width, height) else tuple(int(v) for v in box)
+            return self.boxes[(height, width)]
+
+    def contains(self, height, width, x, y):
+        """True if the point (x, y) of a frame of the given size is processed"""
+        mask = self.mask(height, width)
+        x = min(max(int(x), 0), width - 1)
+        y = min(max(int(y), 0), height - 1)
+        return mask[y, x] != 0
@@ -18,6 +18,8 @@ import cv2
 import numpy as np
 import os
 import random
+import time
+import multiprocessing
 
 import openface
 import openface.helper
@@ -74,7 +76,11 @@ def computeMeanMain(args):
     plt.savefig("{}/mean.png".format(args.modelDir))
 
 
-def alignMain(inputDir,outputDir,landmarks,dlibFacePredictor,size):
+def alignMain(inputDir,outputDir,landmarks,dlibFacePredictor,size,workers=None,chunksize=4,progress=None):
+    """Aligns every image in inputDir that has not been aligned yet.
+    With more than one worker images are distributed in chunks to a
+    pool of processes, each with its own AlignDlib instance. progress
+    is called with ("aligning", done, total) after every image"""
     openface.helper.mkdirP(outputDir)
 
     imgs = list(iterImgs(inputDir))
@@ -91,29 +97,76 @@ def alignMain(inputDir,outputDir,landmarks,dlibFacePredictor,size):
 
     landmarkIndices = landmarkMap[landmarks]
 
-    align = openface.AlignDlib(dlibFacePredictor)
-
-    nFallbacks = 0
+    jobs = []
     for imgObject in imgs:
-        print("=== {} ===".format(imgObject.path))
         outDir = os.path.join(outputDir, imgObject.cls)
         openface.helper.mkdirP(outDir)
-        outputPrefix = os.path.join(outDir, imgObject.name)
-        imgName = outputPrefix + ".png"
-
+        imgName = os.path.join(outDir, imgObject.name) + ".png"
         if os.path.isfile(imgName):
-            print("  + Already found, skipping.")
+            print("=== {} ===\n  + Already found, skipping.".format(imgObject.path))
         else:
-            rgb = imgObject.getRGB()
-            if rgb is None:
-                print("  + Unable to load.")
-                outRgb = None
+            jobs.append((imgObject, imgName))
+
+    if not jobs:
+        return
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(jobs)))
+    print("Aligning {} of {} images with {} workers.".format(len(jobs), len(imgs), workers))
+
+    start = time.time()
+    if workers == 1:
+        _initAlignWorker(dlibFacePredictor, size, landmarkIndices)
+        results = map(_alignImage, jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, initializer=_initAlignWorker,
+                                    initargs=(dlibFacePredictor, size, landmarkIndices))
+        results = pool.imap_unordered(_alignImage, jobs, chunksize)
+
+    aligned = 0
+    completed = False
+    try:
+        for i, (path, status, seconds) in enumerate(results):
+            print("=== [{}/{}] {} ({:.2f}s) ===\n  + {}".format(i + 1, len(jobs), path, seconds, status))
+            if progress is not None:
+                progress("aligning", i + 1, len(jobs))
+            if status == "Writing aligned file to disk.":
+                aligned += 1
+        completed = True
+    finally: # The workers are always shut down, also when alignment raises
+        if pool is not None:
+            if completed:
+                pool.close()
             else:
-                outRgb = align.align(size, rgb, landmarkIndices=landmarkIndices)                           
-                if outRgb is None:
-                    print("  + Unable to align.")           
-
-            if outRgb is not None:
-                print("  + Writing aligned file to disk.")
-                outBgr = cv2.cvtColor(outRgb, cv2.COLOR_RGB2BGR)
-                cv2.imwrite(imgName, outBgr)
+                pool.terminate() # Drops the images still queued
+            pool.join()
+    print("Aligned {} images in {:.2f} seconds.".format(aligned, time.time() - start))
+
+
+_align = None # AlignDlib instance of the current alignment worker
+_alignSize = None
+_alignLandmarkIndices = None
+
+def _initAlignWorker(dlibFacePredictor, size, landmarkIndices):
+    global _align, _alignSize, _alignLandmarkIndices
+    _align = openface.AlignDlib(dlibFacePredictor)
+    _alignSize = size
+    _alignLandmarkIndices = landmarkIndices
+
+def _alignImage(job):
+    """Aligns one image and writes it to disk, returns the image's
+    path, what happened to it and how long it took"""
+    imgObject, imgName = job
+    start = time.time()
+    rgb = imgObject.getRGB()
+    if rgb is None:
+        return imgObject.path, "Unable to load.", time.time() - start
+
+    outRgb = _align.align(_alignSize, rgb, landmarkIndices=_alignLandmarkIndices)
+    if outRgb is None:
+        return imgObject.path, "Unable to align.", time.time() - start
+
+    outBgr = cv2.cvtColor(outRgb, cv2.COLOR_RGB2BGR)
+    cv2.imwrite(imgName, outBgr)
+    return imgObject.path, "Writing aligned file to disk.", time.time() - start
@@ -0,0 +1,275 @@
+# Benchmark.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks the processing stages of the system on synthetic input.
+# Run from the system directory, i.e python benchmark.py motion
+
+import argparse
+import tracemalloc
+import time
+import numpy as np
+import MotionDetector
+
+def synthetic_frames(count, width, height, seed=0):
+    """Yields noisy frames of a static scene with a person sized
+    block walking across it, so the motion stage does real work"""
+    rng = np.random.RandomState(seed)
+    scene = rng.randint(60, 200, (height, width, 3)).astype(np.uint8)
+    noises = [rng.randint(-6, 7, (height, width, 3)).astype(np.int16) for _ in range(4)] # Generated up front so the frames are produced without allocating
+    mixed = np.empty((height, width, 3), dtype=np.int16)
+    frame = np.empty_like(scene)
+    blockWidth, blockHeight = width // 10, height // 3
+    for i in range(count):
+        np.add(scene, noises[i % len(noises)], out=mixed)
+        np.clip(mixed, 0, 255, out=frame, casting='unsafe')
+        x = (i * 8) % (width - blockWidth)
+        frame[height // 3:height // 3 + blockHeight, x:x + blockWidth] = 20
+        yield frame
+
+def report(name, latencies):
+    latencies = np.array(latencies) * 1000.0
+    print("{:<32} mean {:7.2f} ms  p50 {:7.2f} ms  p95 {:7.2f} ms".format(
+        name, latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 95)))
+
+def bench_motion(args):
+    detector = MotionDetector.MotionDetector(analysisWidth=args.analysisWidth)
+    frames = synthetic_frames(args.warmup + args.frames, args.width, args.height)
+    for _ in range(args.warmup): # Allocates the buffers and builds the background model
+        detector.detect_movement(next(frames), get_rects=True)
+
+    latencies = []
+    tracemalloc.start() # numpy allocates the arrays returned by OpenCV, so they are traced
+    baseline = tracemalloc.get_traced_memory()[0]
+    for frame in frames:
+        t = time.time()
+        detector.detect_movement(frame, get_rects=True)
+        latencies.append(time.time() - t)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    report("detect_movement {}x{} at {}".format(args.width, args.height, args.analysisWidth or args.width), latencies)
+    print("peak memory allocated while processing frames {} bytes".format(peak - baseline))
+
+def bench_detect(args):
+    import FaceDetector
+    detector = FaceDetector.FaceDetector()
+    frames = synthetic_frames(args.frames, 640, 360)
+    crops = [[frame[:, i * 640 // args.crops:(i + 1) * 640 // args.crops].copy() for i in range(args.crops)]
+             for frame in frames]
+    detector.detect_faces_batch(crops[0]) # Initialises the network
+
+    sequential, batched = [], []
+    for images in crops:
+        t = time.time()
+        for image in images:
+            detector.detect_dnn_face(image)
+        sequential.append(time.time() - t)
+        t = time.time()
+        detector.detect_faces_batch(images)
+        batched.append(time.time() - t)
+    report("{} crops, one forward each".format(args.crops), sequential)
+    report("{} crops, one batched forward".format(args.crops), batched)
+
+def embeddings_per_second(net, batch, iterations):
+    net.forward(batch) # Warm up
+    start = time.time()
+    for _ in range(iterations):
+        net.forward(batch)
+    return iterations * batch.shape[0] / (time.time() - start)
+
+def bench_openface(args):
+    import torch
+    import loadOpenFace
+    import OpenFaceEngine
+    batch = torch.rand(args.batch, 3, 96, 96)
+    eager = loadOpenFace.prepareOpenFace(useCuda=False).eval() # The network as run before the engine
+    engine = OpenFaceEngine.OpenFaceEngine(loadOpenFace.prepareOpenFace(useCuda=False), threads=args.threads)
+
+    with torch.no_grad():
+        drift = (eager.forward(batch) - engine.forward(batch)).abs().max().item()
+    eagerRate = embeddings_per_second(eager, batch, args.iterations)
+    engineRate = embeddings_per_second(engine, batch, args.iterations)
+    print("eager with autograd      {:8.1f} embeddings/s".format(eagerRate))
+    print("OpenFaceEngine           {:8.1f} embeddings/s  ({:.2f}x)".format(engineRate, engineRate / eagerRate))
+    print("largest embedding difference {:.2e}".format(drift))
+
+def bench_quantized(args):
+    import torch
+    import loadOpenFace
+    import OpenFaceEngine
+    import FaceGallery
+    images = OpenFaceEngine.aligned_images(args.images)
+    faces, read = OpenFaceEngine.load_faces([path for name, path in images])
+    if len(read) == 0:
+        print("no aligned faces in " + args.images)
+        return
+    names = [images[i][0] for i in read]
+    calibration = OpenFaceEngine.calibration_faces(args.images, args.calibration)
+    floatNet = OpenFaceEngine.OpenFaceEngine(loadOpenFace.prepareOpenFace(useCuda=False), threads=args.threads)
+    int8Net = OpenFaceEngine.OpenFaceEngine(loadOpenFace.prepareOpenFace(useCuda=False), threads=args.threads,
+                                            calibration=calibration)
+    if not int8Net.quantized:
+        print("the installed torch cannot quantise the network")
+        return
+
+    floatReps = torch.cat([floatNet(batch) for batch in torch.split(faces, args.batch)]).numpy()
+    int8Reps = torch.cat([int8Net(batch) for batch in torch.split(faces, args.batch)]).numpy()
+    drift = np.sum((floatReps - int8Reps) ** 2, axis=1) # Squared l2 distance, as FaceGallery measures it
+    gallery = FaceGallery.FaceGallery() # Enrolled with float embeddings, as galleries are today
+    gallery.build(floatReps, names)
+    floatNames = np.array(gallery.match(floatReps)[0])
+    int8Names = np.array(gallery.match(int8Reps)[0])
+    floatAccuracy = np.mean(floatNames == np.array(names))
+    int8Accuracy = np.mean(int8Names == np.array(names))
+    agreement = np.mean(floatNames == int8Names)
+
+    batch = faces[:args.batch]
+    floatRate = embeddings_per_second(floatNet, batch, args.iterations)
+    int8Rate = embeddings_per_second(int8Net, batch, args.iterations)
+    print("{} faces of {} people, calibrated on {}".format(len(faces), len(set(names)), len(calibration)))
+    print("float32                  {:8.1f} embeddings/s".format(floatRate))
+    print("int8                     {:8.1f} embeddings/s  ({:.2f}x)".format(int8Rate, int8Rate / floatRate))
+    print("squared l2 drift         mean {:.4f}  p95 {:.4f}  max {:.4f}  (same person below {})".format(
+        drift.mean(), np.percentile(drift, 95), drift.max(), FaceGallery.SAME_PERSON_DISTANCE))
+    print("gallery accuracy         float32 {:.1%}  int8 {:.1%}  identical predictions {:.1%}".format(
+        floatAccuracy, int8Accuracy, agreement))
+
+def bench_svm(args):
+    import pickle
+    import EmbeddingStore
+    import LinearSVMPredictor
+    with open(args.classifier, 'rb') as f:
+        le, clf = pickle.load(f, encoding='bytes')
+    predictor = LinearSVMPredictor.LinearSVMPredictor.compile(clf)
+    if predictor is None:
+        print("{} is not a linear SVM with probability estimates".format(args.classifier))
+        return
+    store = EmbeddingStore.EmbeddingStore.load(args.embeddings)
+    reps = np.asarray(store.embeddings) if store is not None and len(store) > 0 else clf.support_vectors_
+    print("{} classes, {} embeddings".format(len(clf.classes_), len(reps)))
+    print("largest probability difference to predict_proba {:.2e}".format(
+        np.abs(predictor.predict_proba(reps) - clf.predict_proba(reps)).max()))
+
+    batch = reps[np.arange(args.faces) % len(reps)]
+    perFace, sklearnBatch, compiled = [], [], []
+    for _ in range(args.iterations):
+        t = time.time()
+        for rep in batch:
+            clf.predict_proba(rep.reshape(1, -1))
+        perFace.append(time.time() - t)
+        t = time.time()
+        clf.predict_proba(batch)
+        sklearnBatch.append(time.time() - t)
+        t = time.time()
+        predictor.predict_proba(batch)
+        compiled.append(time.time() - t)
+    report("predict_proba per face x{}".format(args.faces), perFace)
+    report("predict_proba batch of {}".format(args.faces), sklearnBatch)
+    report("LinearSVMPredictor batch of {}".format(args.faces), compiled)
+
+def loop_lrn(input, size, alpha, beta, k):
+    """A channel by channel reference LRN over nn.LocalResponseNorm's
+    window of size // 2 channels before and (size - 1) // 2 after each
+    channel. Each window sum is the previous one plus the channel
+    entering it minus the channel leaving it"""
+    import torch
+    channels = input.size(1)
+    squares = input * input
+    scale = torch.empty_like(input)
+    scale[:, 0] = squares[:, :(size - 1) // 2 + 1].sum(1)
+    for c in range(1, channels):
+        scale[:, c] = scale[:, c - 1]
+        if c + (size - 1) // 2 < channels:
+            scale[:, c] += squares[:, c + (size - 1) // 2]
+        if c - size // 2 - 1 >= 0:
+            scale[:, c] -= squares[:, c - size // 2 - 1]
+    return input * (scale * (alpha / size) + k).pow(-beta)
+
+def bench_lrn(args):
+    import torch
+    import torch.nn as nn
+    from SpatialCrossMapLRN import SpatialCrossMapLRN
+    size, alpha, beta, k = 5, 0.0001, 0.75, 1.0 # As in layer5 and layer12 of the OpenFace network
+    lrn = SpatialCrossMapLRN(size, alpha, beta, k)
+    traced = torch.jit.trace(lrn, torch.rand(2, 64, 24, 24))
+    reference = nn.LocalResponseNorm(size, alpha, beta, k)
+    implementations = [("python channel loop", lambda x: loop_lrn(x, size, alpha, beta, k)),
+                       ("nn.LocalResponseNorm", reference),
+                       ("SpatialCrossMapLRN", lrn),
+                       ("SpatialCrossMapLRN traced", traced)]
+
+    for channels in (64, 192): # The channels of the maps layer5 and layer12 normalise, both 24x24 for 96x96 faces
+        batch = torch.rand(args.batch, channels, 24, 24) * 10
+        with torch.no_grad():
+            expected = reference(batch)
+            for name, implementation in implementations:
+                implementation(batch) # Warm up
+                latencies = []
+                for _ in range(args.iterations):
+                    t = time.time()
+                    output = implementation(batch)
+                    latencies.append(time.time() - t)
+                report("{} {} channels".format(name, channels), latencies)
+                print("{:<32} largest difference to nn.LocalResponseNorm {:.2e}".format(
+                    "", (output - expected).abs().max().item()))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the processing stages of the system")
+    subparsers = parser.add_subparsers(dest='stage')
+    subparsers.required = True
+
+    motion = subparsers.add_parser('motion', help="MotionDetector.detect_movement per frame latency and allocations")
+    motion.add_argument('--frames', type=int, default=300)
+    motion.add_argument('--warmup', type=int, default=10)
+    motion.add_argument('--width', type=int, default=1280)
+    motion.add_argument('--height', type=int, default=720)
+    motion.add_argument('--analysisWidth', type=int, default=MotionDetector.ANALYSIS_WIDTH,
+                        help="Width frames are downsampled to, 0 analyses frames at full size")
+    motion.set_defaults(run=bench_motion)
+
+    detect = subparsers.add_parser('detect', help="FaceDetector SSD latency for several crops, sequential vs batched")
+    detect.add_argument('--frames', type=int, default=50)
+    detect.add_argument('--crops', type=int, default=4)
+    detect.set_defaults(run=bench_detect)
+
+    openface = subparsers.add_parser('openface', help="OpenFace embeddings per second, eager network vs OpenFaceEngine on the CPU")
+    openface.add_argument('--batch', type=int, default=8)
+    openface.add_argument('--iterations', type=int, default=20)
+    openface.add_argument('--threads', type=int, default=None, help="Intra-op threads of the engine")
+    openface.set_defaults(run=bench_openface)
+
+    quantized = subparsers.add_parser('quantized', help="int8 vs float32 OpenFace network, embedding drift, gallery accuracy and speed")
+    quantized.add_argument('--images', default='aligned-images', help="Directory of aligned faces, a subdirectory per person")
+    quantized.add_argument('--calibration', type=int, default=64, help="Faces the int8 network is calibrated on")
+    quantized.add_argument('--batch', type=int, default=8)
+    quantized.add_argument('--iterations', type=int, default=20)
+    quantized.add_argument('--threads', type=int, default=None, help="Intra-op threads of both networks")
+    quantized.set_defaults(run=bench_quantized)
+
+    svm = subparsers.add_parser('svm', help="Classifier latency and agreement, sklearn predict_proba vs LinearSVMPredictor")
+    svm.add_argument('--classifier', default='generated-embeddings/classifier.pkl')
+    svm.add_argument('--embeddings', default='generated-embeddings/embeddings.bin', help="EmbeddingStore the faces are taken from")
+    svm.add_argument('--faces', type=int, default=8)
+    svm.add_argument('--iterations', type=int, default=100)
+    svm.set_defaults(run=bench_svm)
+
+    lrn = subparsers.add_parser('lrn', help="Cross channel LRN latency, channel loop vs vectorised SpatialCrossMapLRN")
+    lrn.add_argument('--batch', type=int, default=8)
+    lrn.add_argument('--iterations', type=int, default=50)
+    lrn.set_defaults(run=bench_lrn)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
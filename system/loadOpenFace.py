@@ -6,12 +6,9 @@ from torch.autograd import Variable
 import torch.backends.cudnn as cudnn
 from collections import OrderedDict
 try:
-    from . SpatialCrossMapLRN_temp import SpatialCrossMapLRN_temp
+    from . SpatialCrossMapLRN import SpatialCrossMapLRN
 except:
-    try:
-        from SpatialCrossMapLRN_temp import SpatialCrossMapLRN_temp
-    except:
-        SpatialCrossMapLRN_temp = None
+    from SpatialCrossMapLRN import SpatialCrossMapLRN
 import os
 import time
 
@@ -45,12 +42,8 @@ def BatchNorm(dim):
     return l
 
 def CrossMapLRN(size, alpha, beta, k=1.0, gpuDevice=0):
-    if SpatialCrossMapLRN_temp is not None:
-        lrn = SpatialCrossMapLRN_temp(size, alpha, beta, k, gpuDevice=gpuDevice)
-        n = Lambda( lambda x,lrn=lrn: Variable(lrn.forward(x.data).cuda(gpuDevice)) if x.data.is_cuda else Variable(lrn.forward(x.data)) )
-    else:
-        n = nn.LocalResponseNorm(size, alpha, beta, k).cuda(gpuDevice)
-    return n
+    # Has no parameters, it is moved to the GPU with the rest of the network
+    return SpatialCrossMapLRN(size, alpha, beta, k)
 
 def Linear(in_dim, out_dim):
     l = torch.nn.Linear(in_dim, out_dim)
@@ -236,7 +229,9 @@ class netOpenFace(nn.Module):
 
 def prepareOpenFace(useCuda=True, gpuDevice=0, useMultiGPU=False):
     model = netOpenFace(useCuda, gpuDevice)
-    model.load_state_dict(torch.load(os.path.join(containing_dir, 'openface.pth')))
+    # The weights were saved from the GPU, they are mapped to the CPU on hosts without one
+    model.load_state_dict(torch.load(os.path.join(containing_dir, 'openface.pth'),
+                                     map_location=None if useCuda else 'cpu'))
 
     if useMultiGPU:
         model = nn.DataParallel(model)
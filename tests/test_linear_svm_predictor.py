@@ -0,0 +1,43 @@
+# Tests of LinearSVMPredictor against sklearn's SVC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'system'))
+
+datasets = pytest.importorskip("sklearn.datasets")
+svm = pytest.importorskip("sklearn.svm")
+
+from LinearSVMPredictor import LinearSVMPredictor
+
+@pytest.mark.parametrize("nClasses", [2, 4])
+def test_matches_sklearn(nClasses):
+    X, y = datasets.make_blobs(n_samples=60 * nClasses, centers=nClasses, n_features=128,
+                               cluster_std=6.0, random_state=0)
+    clf = svm.SVC(kernel='linear', probability=True, random_state=0).fit(X, y)
+    predictor = LinearSVMPredictor.compile(clf)
+    assert predictor is not None
+
+    probabilities = predictor.predict_proba(X)
+    assert np.allclose(probabilities, clf.predict_proba(X), atol=1e-6)
+    assert np.array_equal(clf.classes_[np.argmax(probabilities, axis=1)], clf.predict(X))
+
+def test_other_classifiers_are_not_compiled():
+    X, y = datasets.make_blobs(n_samples=40, centers=2, random_state=0)
+    assert LinearSVMPredictor.compile(svm.SVC(kernel='rbf', probability=True).fit(X, y)) is None
+    assert LinearSVMPredictor.compile(svm.SVC(kernel='linear').fit(X, y)) is None
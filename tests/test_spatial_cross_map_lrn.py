@@ -0,0 +1,43 @@
+# Tests of the cumsum SpatialCrossMapLRN against the channel by channel loop.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'system'))
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("cv2") # benchmark imports MotionDetector
+
+from benchmark import loop_lrn
+from SpatialCrossMapLRN import SpatialCrossMapLRN
+
+ALPHA, BETA, K = 1e-4, 0.75, 1.0 # As in the OpenFace network
+
+@pytest.mark.parametrize("size", [3, 4, 5])
+@pytest.mark.parametrize("channels", [1, 2, 3, 5, 7, 64])
+def test_matches_loop(size, channels):
+    torch.manual_seed(0)
+    input = torch.randn(2, channels, 6, 6, dtype=torch.float64) * 10 # Large enough that the normalisation matters
+    expected = loop_lrn(input, size, ALPHA, BETA, K)
+    assert torch.allclose(SpatialCrossMapLRN(size, ALPHA, BETA, K)(input), expected, rtol=1e-10, atol=1e-12)
+    assert torch.allclose(torch.nn.LocalResponseNorm(size, ALPHA, BETA, K)(input), expected, rtol=1e-10, atol=1e-12)
+
+def test_traced_matches_loop():
+    input = torch.randn(2, 64, 24, 24)
+    lrn = SpatialCrossMapLRN(5, ALPHA, BETA, K)
+    traced = torch.jit.trace(lrn, torch.rand(1, 64, 24, 24))
+    assert torch.allclose(traced(input), loop_lrn(input, 5, ALPHA, BETA, K), rtol=1e-5, atol=1e-6)